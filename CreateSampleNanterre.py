@@ -5,34 +5,12 @@ Created on Mon Aug 21 09:33:15 2017
 
 @author: DIALLO_MAM
 """
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+import sampler  # modes: every k, reservoir, bbox, complete
 
 OSM_FILE = "Nanterre.osm"  # Replace this with your osm file
 SAMPLE_FILE = "sampleNanterre.osm"
 
 k = 12 # Parameter: take every k-th top level element
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag
-
-    Reference:
-    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
-    """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
-
-
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
-
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
-
-    output.write('</osm>')
+# Write every kth top level element
+sampler.sample(OSM_FILE, SAMPLE_FILE, sampler.select_every(k))
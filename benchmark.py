@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the wrangling pipeline (wrangle.py).
+
+Input is either the Nanterre sample (sampleNanterre.osm.zip, the default)
+or a synthetic osm file of configurable size and tag density. Every
+benchmark runs in its own process so that its peak RSS is its own:
+
+  stages       one export pass timed per stage: parse (get_element),
+               shape (shape_element without the cleaners), clean (the
+               TAG_CLEANERS normalizers), validate (FastValidator) and
+               write (csv)
+  normalizers  update_name, update_housenb and update_phone on the
+               values of the file, without the LRU caches
+  audit        audit_map with every audit visitor
+  process_map  end to end csv export
+  process_map_tuple
+               the same with rows='tuple' (tuple rows, csv.writer)
+
+Each run appends one JSON line to the results file (elements/s, MB/s,
+peak RSS and stage times, with the git commit) so that runs can be
+compared across commits.
+
+Usage:
+  python benchmark.py
+  python benchmark.py --synthetic 200000 --tags 3 --output bench.jsonl
+  python benchmark.py --osm Nanterre.osm --only stages process_map
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+from collections import defaultdict
+from timeit import default_timer as clock
+
+import wrangle
+
+SAMPLE_ZIP = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "sampleNanterre.osm.zip")
+RESULTS_PATH = "benchmark.jsonl"
+BENCHMARKS = ('stages', 'normalizers', 'audit', 'process_map', 'process_map_tuple')
+
+
+###
+# OBJECTIVE: synthetic osm file of configurable size and tag density
+###
+SYNTHETIC_TAGS = [
+    ('addr:street', [u'rue de la Paix', u'Avenue Pablo Picasso', u'RUE Gambetta',
+                     u'boulevard de la Défense', u'Pl de la Boule', u'Allée des Tilleuls']),
+    ('addr:housenumber', ['12', '12B', '3 bis', '5T', '7;9', '21-23', '4 Quater']),
+    ('phone', ['01 47 29 51 00', '+33 1 41193500', '01.49.61.06.34', '3631',
+               '0033147493186', '01.47.21.14.27; 01.47.24.08.68']),
+    ('building', ['yes', 'house', 'apartments']),
+    ('highway', ['residential', 'footway', 'service', 'bus_stop']),
+    ('name', [u'Mairie', u'École Voltaire', u'Parc André Malraux']),
+    ('amenity', ['bench', 'parking', 'restaurant', 'school']),
+    ('source', [u'cadastre-dgi-fr source : Direction Générale des Impôts - Cadastre']),
+]
+
+def generate_osm(path, nodes=100000, tags=2.0, ways_ratio=0.15, way_nodes=8, seed=0):
+    """Write a synthetic osm file: nodes, then ways over those nodes
+
+    tags is the mean number of tags per element and ways_ratio the number
+    of ways per node. Values are drawn from SYNTHETIC_TAGS so that every
+    cleaner is exercised.
+    """
+    rng = random.Random(seed)
+    attrs = 'changeset="%d" uid="%d" user="user%d" version="%d" timestamp="2017-08-16T14:18:00Z"'
+
+    def write_tags(out):
+        for _ in range(int(rng.expovariate(1.0 / tags)) if tags else 0):
+            key, values = rng.choice(SYNTHETIC_TAGS)
+            out.write(('\t\t<tag k="%s" v="%s" />\n' % (key, rng.choice(values)))
+                      .encode('utf-8'))
+
+    with open(path, 'wb', 1 << 20) as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for i in range(1, nodes + 1):
+            uid = rng.randint(1, 500)
+            out.write('\t<node id="%d" lat="%.7f" lon="%.7f" %s>\n' % (
+                i, 48.85 + rng.random() * 0.1, 2.15 + rng.random() * 0.1,
+                attrs % (rng.randint(1, 10 ** 7), uid, uid, rng.randint(1, 9))))
+            write_tags(out)
+            out.write('\t</node>\n')
+        for i in range(1, int(nodes * ways_ratio) + 1):
+            uid = rng.randint(1, 500)
+            out.write('\t<way id="%d" %s>\n' % (
+                i, attrs % (rng.randint(1, 10 ** 7), uid, uid, rng.randint(1, 9))))
+            for _ in range(way_nodes):
+                out.write('\t\t<nd ref="%d" />\n' % rng.randint(1, nodes))
+            write_tags(out)
+            out.write('\t</way>\n')
+        out.write('</osm>\n')
+
+
+###
+# OBJECTIVE: the benchmarks, each one run in a child process
+###
+def _peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_stages(osm_file, work_dir):
+    """One export pass with the time of every stage"""
+    timers = defaultdict(float)
+
+    def timed(cleaner):
+        def clean(value):
+            start = clock()
+            result = cleaner(value)
+            timers['clean'] += clock() - start
+            return result
+        return clean
+
+    wrangle.set_cache_size(0)
+    cleaners = dict(wrangle.TAG_CLEANERS)
+    for key, cleaner in cleaners.items():
+        wrangle.TAG_CLEANERS[key] = timed(cleaner)
+
+    validator = wrangle.FastValidator()
+    os.chdir(work_dir)
+    count = 0
+    start_all = clock()
+    try:
+        with wrangle.CsvExporter() as exporter:
+            writers = {'node': exporter.write_node, 'way': exporter.write_way,
+                       'relation': exporter.write_relation}
+            elements = wrangle.get_element(osm_file, tags=wrangle.EXPORT_TAGS)
+            while True:
+                t0 = clock()
+                element = next(elements, None)
+                t1 = clock()
+                if element is None:
+                    break
+                el = wrangle.shape_element(element)
+                t2 = clock()
+                validator.check(el)
+                t3 = clock()
+                writers[element.tag](el)
+                t4 = clock()
+                timers['parse'] += t1 - t0
+                timers['shape'] += t2 - t1
+                timers['validate'] += t3 - t2
+                timers['write'] += t4 - t3
+                count += 1
+            t0 = clock()
+            validator.flush()
+            timers['validate'] += clock() - t0
+    finally:
+        wrangle.TAG_CLEANERS.update(cleaners)
+    # shape_element calls the cleaners
+    timers['shape'] -= timers['clean']
+    return {'elements': count, 'seconds': clock() - start_all,
+            'stages': dict(timers)}
+
+
+def bench_normalizers(osm_file, work_dir):
+    """Calls per second of the normalizers on the values of the file"""
+    values = defaultdict(list)
+    for element in wrangle.get_element(osm_file, tags=wrangle.EXPORT_TAGS):
+        for tag in element.iter('tag'):
+            k = tag.attrib['k']
+            if k in wrangle.TAG_CLEANERS:
+                values[k.split(':')[-1]].append(tag.attrib['v'].strip())
+
+    normalizers = {
+        'update_name': (lambda v: wrangle.update_name(v, wrangle.mapping),
+                        values['street']),
+        'update_housenb': (lambda v: wrangle.update_housenb(v, wrangle.bis_ter_quater),
+                           values['housenumber']),
+        'update_phone': (wrangle.update_phone,
+                         values['phone'] + values['mobile']),
+    }
+    results = {}
+    for name, (func, items) in normalizers.items():
+        start = clock()
+        for item in items:
+            func(item)
+        seconds = clock() - start
+        results[name] = {'calls': len(items), 'seconds': seconds,
+                         'calls_per_sec': len(items) / seconds if seconds else None}
+    # batch versions: the whole column in one call
+    columns = {
+        'normalize_housenumbers': (wrangle.normalize_housenumbers, values['housenumber']),
+        'normalize_phones': (wrangle.normalize_phones, values['phone'] + values['mobile']),
+    }
+    for name, (func, items) in columns.items():
+        start = clock()
+        func(items)
+        seconds = clock() - start
+        results[name] = {'calls': len(items), 'seconds': seconds,
+                         'calls_per_sec': len(items) / seconds if seconds else None}
+    return {'elements': None, 'seconds': sum(r['seconds'] for r in results.values()),
+            'normalizers': results}
+
+
+def bench_audit(osm_file, work_dir):
+    """All the audit visitors in one audit_map pass"""
+    visitors = [wrangle.EmptyValuesAudit(), wrangle.HouseNumberAudit(),
+                wrangle.FirstElementsAudit(), wrangle.TagCountAudit(),
+                wrangle.StreetTypeAudit(), wrangle.PhoneAudit()]
+    start = clock()
+    results = wrangle.audit_map(osm_file, visitors)
+    tags = results[3]
+    count = sum(tags.get(tag, 0) for tag in wrangle.EXPORT_TAGS)
+    return {'elements': count, 'seconds': clock() - start}
+
+
+def bench_process_map(osm_file, work_dir, rows='dict'):
+    """End to end csv export"""
+    os.chdir(work_dir)
+    start = clock()
+    wrangle.process_map(osm_file, False, rows=rows)
+    seconds = clock() - start
+    with open(wrangle.NODES_PATH) as f:
+        nodes = sum(1 for _ in f) - 1
+    with open(wrangle.WAYS_PATH) as f:
+        ways = sum(1 for _ in f) - 1
+    with open(wrangle.RELATIONS_PATH) as f:
+        relations = sum(1 for _ in f) - 1
+    return {'elements': nodes + ways + relations, 'seconds': seconds}
+
+
+def bench_process_map_tuple(osm_file, work_dir):
+    """End to end csv export, tuple rows fast path"""
+    return bench_process_map(osm_file, work_dir, rows='tuple')
+
+
+def _run(args):
+    name, osm_file, work_dir = args
+    result = globals()['bench_' + name](osm_file, work_dir)
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+
+def run_isolated(name, osm_file, work_dir):
+    """Run one benchmark in a fresh child process"""
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(_run, ((name, osm_file, work_dir),))
+    finally:
+        pool.close()
+        pool.join()
+
+
+###
+# OBJECTIVE: run the benchmarks and append the results to a JSON lines file
+###
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(osm_file, benchmarks=BENCHMARKS, results_path=RESULTS_PATH, label=None):
+    size_mb = os.path.getsize(osm_file) / 1e6
+    record = {
+        'commit': git_commit(),
+        'label': label,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'input': {'path': osm_file, 'size_mb': size_mb},
+        'results': {},
+    }
+    work_dir = tempfile.mkdtemp(prefix='osm_bench_')
+    try:
+        for name in benchmarks:
+            result = run_isolated(name, os.path.abspath(osm_file), work_dir)
+            seconds = result['seconds']
+            if result['elements'] and seconds:
+                result['elements_per_sec'] = result['elements'] / seconds
+                result['mb_per_sec'] = size_mb / seconds
+            record['results'][name] = result
+            print "%-18s %8.2f s  %s elements/s  %s MB/s  peak RSS %.0f MB" % (
+                name, seconds,
+                '%.0f' % result['elements_per_sec'] if 'elements_per_sec' in result else '-',
+                '%.1f' % result['mb_per_sec'] if 'mb_per_sec' in result else '-',
+                result['peak_rss_mb'])
+            for stage, stage_seconds in sorted(result.get('stages', {}).items()):
+                print "    %-8s %8.2f s" % (stage, stage_seconds)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(results_path, 'a') as out:
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the wrangling pipeline')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--osm', help='osm file to use (default: the Nanterre sample)')
+    source.add_argument('--synthetic', type=int, metavar='NODES',
+                        help='generate a synthetic file with NODES nodes')
+    parser.add_argument('--tags', type=float, default=2.0,
+                        help='mean number of tags per synthetic element')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--output', default=RESULTS_PATH,
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--label', help='free text stored with the results')
+    args = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix='osm_bench_input_')
+    try:
+        if args.osm:
+            osm_file = args.osm
+        elif args.synthetic:
+            osm_file = os.path.join(tmp_dir, 'synthetic.osm')
+            generate_osm(osm_file, nodes=args.synthetic, tags=args.tags)
+        else:
+            with zipfile.ZipFile(SAMPLE_ZIP) as archive:
+                name = archive.namelist()[0]
+                archive.extract(name, tmp_dir)
+            osm_file = os.path.join(tmp_dir, name)
+        run(osm_file, args.only, args.output, args.label)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
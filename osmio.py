@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Plain and compressed osm input, plain and gzip csv output.
+
+open_osm() reads .osm, .osm.gz, .osm.bz2 and .zip files. Decompression
+is pipelined with the xml parsing: it runs in a separate process
+(pigz/gzip, lbzip2/pbzip2/bzip2 when installed) or, failing that, in a
+reader thread that keeps a few blocks ahead of the parser.
+"""
+
+import bz2
+import gzip
+import subprocess
+import threading
+import zipfile
+import Queue
+from distutils.spawn import find_executable
+
+BLOCK_SIZE = 1 << 20
+PREFETCH_BLOCKS = 8
+GZIP_LEVEL = 3
+GZ_SUFFIX = '.gz'
+
+# external decompressors, the parallel ones first
+DECOMPRESSORS = {
+    '.gz': ['pigz', 'gzip'],
+    '.bz2': ['lbzip2', 'pbzip2', 'bzip2'],
+}
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.zip')
+
+
+def is_compressed(path):
+    return path.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+###
+# OBJECTIVE: read the output of an external decompressor
+###
+class PipeReader(object):
+    """File-like stdout of `<program> -dc path`, running in its own process"""
+
+    def __init__(self, program, path):
+        self.proc = subprocess.Popen([program, '-dc', path],
+                                     stdout=subprocess.PIPE, bufsize=BLOCK_SIZE)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        self.bytes_read += len(data)
+        if not data and self.proc.poll() not in (None, 0):
+            raise IOError("decompression failed with exit code %d"
+                          % self.proc.returncode)
+        return data
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+###
+# OBJECTIVE: decompress in a thread, a few blocks ahead of the reader
+###
+class PrefetchReader(object):
+    """File-like wrapper reading source in a background thread
+
+    bz2 and zlib release the GIL while decompressing, so the thread
+    decompresses the next blocks while the caller parses this one.
+    """
+
+    def __init__(self, source, block_size=BLOCK_SIZE, blocks=PREFETCH_BLOCKS):
+        self.source = source
+        self.block_size = block_size
+        self.queue = Queue.Queue(blocks)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.closed = False
+        self.bytes_read = 0
+        self.thread = threading.Thread(target=self._fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while not self.closed:
+                block = self.source.read(self.block_size)
+                self.queue.put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self.queue.put(e)
+
+    def read(self, size=-1):
+        chunks = []
+        want = size
+        while size < 0 or want > 0:
+            if self.pos >= len(self.buf):
+                if self.eof:
+                    break
+                block = self.queue.get()
+                if isinstance(block, Exception):
+                    raise block
+                if not block:
+                    self.eof = True
+                    break
+                self.buf, self.pos = block, 0
+            if size < 0:
+                piece = self.buf[self.pos:]
+            else:
+                piece = self.buf[self.pos:self.pos + want]
+                want -= len(piece)
+            self.pos += len(piece)
+            chunks.append(piece)
+        data = ''.join(chunks)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.closed = True
+        # unblock the thread if it waits on a full queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+###
+# OBJECTIVE: open an osm file, compressed or not
+###
+def open_osm(path):
+    """Return a binary file-like object with the xml of an osm file"""
+    lower = path.lower()
+    if lower.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        names = archive.namelist()
+        osm_names = [name for name in names if name.lower().endswith('.osm')]
+        return PrefetchReader(archive.open((osm_names or names)[0]))
+    for suffix, programs in DECOMPRESSORS.iteritems():
+        if lower.endswith(suffix):
+            for program in programs:
+                if find_executable(program):
+                    return PipeReader(program, path)
+            if suffix == '.gz':
+                return PrefetchReader(gzip.GzipFile(path, 'rb'))
+            return PrefetchReader(bz2.BZ2File(path, 'rb'))
+    return open(path, 'rb')
+
+
+def position(f):
+    """Number of (uncompressed) bytes read so far from an open_osm file"""
+    try:
+        return f.bytes_read
+    except AttributeError:
+        return f.tell()
+
+
+###
+# OBJECTIVE: csv output file, gzip compressed or not
+###
+def open_output(path, compress=False, append=False):
+    # TIP: use of wb instead of w for avoiding blank line.
+    mode = 'ab' if append else 'wb'
+    if compress:
+        return gzip.GzipFile(path, mode, GZIP_LEVEL)
+    return open(path, mode)
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+Pure Python reader of OpenStreetMap .osm.pbf files.
+
+The file is a sequence of blobs (zlib compressed protobuf messages); each
+data blob holds a string table and groups of nodes (plain or delta coded
+"dense" nodes), ways and relations. PbfReader decodes the blobs in a
+process pool, in file order, and yields the same ElementTree elements as
+parsing the .osm xml (node/way/relation with their tag, nd and member
+children, attributes as strings), so shape_element and the audits work
+on them unchanged.
+
+Usage:
+  for element in PbfReader('Nanterre.osm.pbf'):
+      ...
+or through wrangle.get_element('Nanterre.osm.pbf').
+"""
+
+import collections
+import multiprocessing
+import struct
+import time
+import zlib
+import xml.etree.cElementTree as ET
+
+PBF_SUFFIX = '.pbf'
+# blobs decoded ahead of the consumer (bounds the memory of the pool)
+PBF_WINDOW = 4
+SUPPORTED_FEATURES = frozenset(['OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation'])
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+
+def is_pbf(path):
+    return isinstance(path, basestring) and path.lower().endswith(PBF_SUFFIX)
+
+
+# ================================================== #
+#               Protobuf decoding                    #
+# ================================================== #
+
+def _varint(buf, pos):
+    """(value, next position) of the varint at buf[pos] (buf: bytearray)"""
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _signed(value):
+    # int32/int64 fields: negative values are sent as 64 bit two's complement
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _zigzag(value):
+    # sint32/sint64 fields
+    return (value >> 1) ^ -(value & 1)
+
+
+def _fields(buf, pos=0, end=None):
+    """Yield (field number, value) of a message in buf[pos:end]
+
+    varints are yielded as int, length delimited fields as a (start, end)
+    slice of buf, fixed 32/64 bit fields as raw bytes.
+    """
+    if end is None:
+        end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 2:
+            size, pos = _varint(buf, pos)
+            value = (pos, pos + size)
+            pos += size
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("unsupported protobuf wire type %d" % wire_type)
+        yield key >> 3, value
+
+
+def _packed(buf, span):
+    """Unsigned varints of a packed repeated field"""
+    pos, end = span
+    values = []
+    append = values.append
+    while pos < end:
+        result = 0
+        shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+
+def _packed_delta(buf, span):
+    """Delta coded sint64 values of a packed repeated field"""
+    values = []
+    append = values.append
+    last = 0
+    for value in _packed(buf, span):
+        last += (value >> 1) ^ -(value & 1)
+        append(last)
+    return values
+
+
+def _text(data):
+    # like cElementTree: str for ascii, unicode otherwise
+    try:
+        data.decode('ascii')
+        return data
+    except UnicodeDecodeError:
+        return data.decode('utf-8')
+
+
+# ================================================== #
+#               Blocks                               #
+# ================================================== #
+
+###
+# OBJECTIVE: decompress the data of a blob
+###
+def blob_data(blob):
+    buf = bytearray(blob)
+    for field, value in _fields(buf):
+        if field == 1:      # raw
+            return bytes(buf[value[0]:value[1]])
+        if field == 3:      # zlib_data
+            return zlib.decompress(bytes(buf[value[0]:value[1]]))
+        if field in (4, 6, 7):
+            raise ValueError("unsupported pbf blob compression (lzma, lz4 or zstd)")
+    return ''
+
+
+def check_header(blob):
+    """Raise ValueError if the OSMHeader block needs an unsupported feature"""
+    buf = bytearray(blob_data(blob))
+    for field, value in _fields(buf):
+        if field == 4:      # required_features
+            feature = bytes(buf[value[0]:value[1]])
+            if feature not in SUPPORTED_FEATURES:
+                raise ValueError("unsupported pbf feature %r" % feature)
+
+
+class _Block(object):
+    """String table and coordinate/date scales of a PrimitiveBlock"""
+
+    def __init__(self, buf):
+        self.strings = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        self.groups = []
+        for field, value in _fields(buf):
+            if field == 1:
+                self.strings = [_text(bytes(buf[start:end]))
+                                for f, (start, end) in _fields(buf, *value) if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = _signed(value)
+            elif field == 19:
+                self.lat_offset = _signed(value)
+            elif field == 20:
+                self.lon_offset = _signed(value)
+            elif field == 18:
+                self.date_granularity = _signed(value)
+
+    def timestamp(self, value):
+        seconds = value * self.date_granularity // 1000
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def _degrees(nanodegrees):
+    """Exact decimal degrees, without trailing zeros, as in the osm xml"""
+    sign = '-' if nanodegrees < 0 else ''
+    whole, frac = divmod(abs(nanodegrees), 1000000000)
+    frac = ('%09d' % frac).rstrip('0')
+    return '%s%d.%s' % (sign, whole, frac) if frac else '%s%d' % (sign, whole)
+
+
+def _info(block, buf, span, attrib):
+    strings = block.strings
+    for field, value in _fields(buf, *span):
+        if field == 1:
+            attrib['version'] = str(_signed(value))
+        elif field == 2:
+            attrib['timestamp'] = block.timestamp(_signed(value))
+        elif field == 3:
+            attrib['changeset'] = str(_signed(value))
+        elif field == 4:
+            attrib['uid'] = str(_signed(value))
+        elif field == 5:
+            attrib['user'] = strings[value]
+
+
+def _tags(block, keys, vals):
+    strings = block.strings
+    return [('tag', {'k': strings[k], 'v': strings[v]}) for k, v in zip(keys, vals)]
+
+
+def _node(block, buf, span):
+    attrib = {}
+    keys = vals = ()
+    lat = lon = 0
+    for field, value in _fields(buf, *span):
+        if field == 1:
+            attrib['id'] = str(_zigzag(value))
+        elif field == 2:
+            keys = _packed(buf, value)
+        elif field == 3:
+            vals = _packed(buf, value)
+        elif field == 4:
+            _info(block, buf, value, attrib)
+        elif field == 8:
+            lat = _zigzag(value)
+        elif field == 9:
+            lon = _zigzag(value)
+    attrib['lat'] = _degrees(block.lat_offset + block.granularity * lat)
+    attrib['lon'] = _degrees(block.lon_offset + block.granularity * lon)
+    return 'node', attrib, _tags(block, keys, vals)
+
+
+def _dense_nodes(block, buf, span):
+    ids = lats = lons = keys_vals = ()
+    info = {}
+    for field, value in _fields(buf, *span):
+        if field == 1:
+            ids = _packed_delta(buf, value)
+        elif field == 5:
+            for info_field, info_value in _fields(buf, *value):
+                if info_field == 1:     # version, not delta coded
+                    info['version'] = [_signed(v) for v in _packed(buf, info_value)]
+                elif info_field in (2, 3, 4, 5):
+                    info[info_field] = _packed_delta(buf, info_value)
+        elif field == 8:
+            lats = _packed_delta(buf, value)
+        elif field == 9:
+            lons = _packed_delta(buf, value)
+        elif field == 10:
+            keys_vals = _packed(buf, value)
+
+    strings = block.strings
+    granularity = block.granularity
+    versions = info.get('version')
+    timestamps = info.get(2)
+    changesets = info.get(3)
+    uids = info.get(4)
+    user_sids = info.get(5)
+    elements = []
+    kv = 0
+    for i, node_id in enumerate(ids):
+        attrib = {'id': str(node_id),
+                  'lat': _degrees(block.lat_offset + granularity * lats[i]),
+                  'lon': _degrees(block.lon_offset + granularity * lons[i])}
+        if versions is not None:
+            attrib['version'] = str(versions[i])
+        if timestamps is not None:
+            attrib['timestamp'] = block.timestamp(timestamps[i])
+        if changesets is not None:
+            attrib['changeset'] = str(changesets[i])
+        if uids is not None:
+            attrib['uid'] = str(uids[i])
+        if user_sids is not None:
+            attrib['user'] = strings[user_sids[i]]
+        children = []
+        # keys_vals: k, v, k, v, ..., 0 for each node
+        while kv < len(keys_vals) and keys_vals[kv] != 0:
+            children.append(('tag', {'k': strings[keys_vals[kv]],
+                                     'v': strings[keys_vals[kv + 1]]}))
+            kv += 2
+        kv += 1
+        elements.append(('node', attrib, children))
+    return elements
+
+
+def _way(block, buf, span):
+    attrib = {}
+    keys = vals = refs = ()
+    for field, value in _fields(buf, *span):
+        if field == 1:
+            attrib['id'] = str(_signed(value))
+        elif field == 2:
+            keys = _packed(buf, value)
+        elif field == 3:
+            vals = _packed(buf, value)
+        elif field == 4:
+            _info(block, buf, value, attrib)
+        elif field == 8:
+            refs = _packed_delta(buf, value)
+    children = [('nd', {'ref': str(ref)}) for ref in refs]
+    return 'way', attrib, children + _tags(block, keys, vals)
+
+
+def _relation(block, buf, span):
+    attrib = {}
+    keys = vals = roles = memids = types = ()
+    for field, value in _fields(buf, *span):
+        if field == 1:
+            attrib['id'] = str(_signed(value))
+        elif field == 2:
+            keys = _packed(buf, value)
+        elif field == 3:
+            vals = _packed(buf, value)
+        elif field == 4:
+            _info(block, buf, value, attrib)
+        elif field == 8:
+            roles = _packed(buf, value)
+        elif field == 9:
+            memids = _packed_delta(buf, value)
+        elif field == 10:
+            types = _packed(buf, value)
+    strings = block.strings
+    children = [('member', {'type': MEMBER_TYPES[t], 'ref': str(ref),
+                            'role': strings[role]})
+                for t, ref, role in zip(types, memids, roles)]
+    return 'relation', attrib, children + _tags(block, keys, vals)
+
+
+###
+# OBJECTIVE: decode a data blob (runs in the pool workers)
+###
+def decode_blob(blob):
+    """[(tag, attrib, [(child tag, child attrib), ...]), ...] of a data blob
+
+    Plain tuples and dicts: cheap to send back from a worker process.
+    """
+    buf = bytearray(blob_data(blob))
+    block = _Block(buf)
+    elements = []
+    for group in block.groups:
+        for field, value in _fields(buf, *group):
+            if field == 1:
+                elements.append(_node(block, buf, value))
+            elif field == 2:
+                elements.extend(_dense_nodes(block, buf, value))
+            elif field == 3:
+                elements.append(_way(block, buf, value))
+            elif field == 4:
+                elements.append(_relation(block, buf, value))
+    return elements
+
+
+def _element(tag, attrib, children):
+    element = ET.Element(tag, attrib)
+    for child_tag, child_attrib in children:
+        ET.SubElement(element, child_tag, child_attrib)
+    return element
+
+
+# ================================================== #
+#               Reader                               #
+# ================================================== #
+
+###
+# OBJECTIVE: iterate over the elements of a .osm.pbf file
+###
+class PbfReader(object):
+    """Iterate over the node, way and relation elements of a .osm.pbf file
+
+    Blobs are read in order and decoded by a pool of processes (processes
+    None: one per cpu, 1: no pool), at most PBF_WINDOW blobs per process
+    ahead of the consumer. bytes_read is the position in the file, for
+    the progress of ExportMetrics.
+    """
+
+    def __init__(self, path, processes=None, window=PBF_WINDOW):
+        self.path = path
+        self.processes = processes or multiprocessing.cpu_count()
+        self.window = window
+        self.file = open(path, 'rb')
+        self.bytes_read = 0
+        self.pool = None
+
+    def blobs(self):
+        """Yield (type, blob) of every blob of the file"""
+        read = self.file.read
+        while True:
+            size = read(4)
+            if not size:
+                return
+            header = bytearray(read(struct.unpack('>I', size)[0]))
+            blob_type = None
+            data_size = 0
+            for field, value in _fields(header):
+                if field == 1:
+                    blob_type = bytes(header[value[0]:value[1]])
+                elif field == 3:
+                    data_size = value
+            blob = read(data_size)
+            self.bytes_read += 4 + len(header) + len(blob)
+            yield blob_type, blob
+
+    def data_blobs(self):
+        for blob_type, blob in self.blobs():
+            if blob_type == 'OSMHeader':
+                check_header(blob)
+            elif blob_type == 'OSMData':
+                yield blob
+
+    def _decoded(self):
+        """Yield the decoded content of every data blob, in file order"""
+        data_blobs = self.data_blobs()
+        if self.processes == 1:
+            for blob in data_blobs:
+                yield decode_blob(blob)
+            return
+        self.pool = multiprocessing.Pool(self.processes)
+        pending = collections.deque()
+        for blob in data_blobs:
+            pending.append(self.pool.apply_async(decode_blob, (blob,)))
+            if len(pending) >= self.processes * self.window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def __iter__(self):
+        try:
+            for elements in self._decoded():
+                for tag, attrib, children in elements:
+                    yield _element(tag, attrib, children)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
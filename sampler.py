@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Create a small sample .osm file from a large one.
+
+Modes:
+  every k      keep every k-th top level element (CreateSample.py)
+  reservoir n  keep n top level elements chosen uniformly at random
+  bbox         keep the nodes inside a bounding box, the ways using one
+               of them and the relations with a kept member
+  --complete   also keep every node referenced by a kept way (second pass)
+               so that the sample has no dangling <nd ref="..."/>
+
+Elements are copied as raw bytes: the input is scanned in large blocks
+for the start of each top level element, nothing is parsed or
+re-serialized with ET.tostring, and the output is buffered.
+
+Usage:
+  python sampler.py Nanterre.osm sampleNanterre.osm --every 10
+  python sampler.py Nanterre.osm.bz2 sample.osm --every 10
+  python sampler.py Nanterre.osm sample.osm --reservoir 5000 --complete
+  python sampler.py Nanterre.osm sample.osm --bbox 48.88,2.19,48.90,2.22
+"""
+
+import argparse
+import random
+import re
+from contextlib import closing
+
+import osmio
+
+BLOCK_SIZE = 1 << 22
+BUFFER_SIZE = 1 << 20
+
+# start of a top level element: nd, tag and member children never match
+ELEMENT_START_RE = re.compile(r'<(node|way|relation)[\s/>]')
+# attribute values are double or single quoted (JOSM): the value is group 2
+ID_RE = re.compile(r'''\sid=(["'])(-?\d+)\1''')
+LAT_RE = re.compile(r'''\slat=(["'])([-+.\deE]+)\1''')
+LON_RE = re.compile(r'''\slon=(["'])([-+.\deE]+)\1''')
+ND_RE = re.compile(r'''<nd\s+ref=(["'])(-?\d+)\1''')
+MEMBER_RE = re.compile(r'<member\s([^>]*)>')
+TYPE_RE = re.compile(r'''\btype=(["'])(\w+)\1''')
+REF_RE = re.compile(r'''\bref=(["'])(-?\d+)\1''')
+
+HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n  '
+FOOTER = '</osm>'
+
+
+###
+# OBJECTIVE: iterate over the raw bytes of each top level element
+###
+def iter_raw_elements(osm_file, block_size=BLOCK_SIZE):
+    """Yield (tag, chunk) for every node, way and relation of osm_file
+
+    chunk is the bytes of the element up to the start of the next one
+    (trailing whitespace included). OSM escapes '<' in attribute values,
+    so the only '<node', '<way' and '<relation' in the file are the
+    element starts.
+    """
+    with closing(osmio.open_osm(osm_file)) as f:
+        buf = ''
+        start = None    # start of the current element in buf
+        tag = None
+        pos = 0         # where to search for the next element start
+        eof = False
+        while not eof:
+            block = f.read(block_size)
+            eof = not block
+            cut = start if start is not None else pos
+            buf = buf[cut:] + block
+            pos -= cut
+            if start is not None:
+                start = 0
+            # a marker starting in the last 16 bytes may be cut in two:
+            # it is searched again once the next block is read
+            limit = len(buf) if eof else len(buf) - 16
+            for m in ELEMENT_START_RE.finditer(buf, pos):
+                if m.start() > limit:
+                    break
+                if start is not None:
+                    yield tag, buf[start:m.start()]
+                start, tag = m.start(), m.group(1)
+                pos = m.end()
+            pos = max(pos, limit + 1)
+
+        if start is not None:
+            # last element: stop before the closing root tag
+            chunk = buf[start:]
+            end = chunk.rfind(FOOTER)
+            yield tag, chunk[:end] if end != -1 else chunk
+
+
+def element_id(chunk):
+    return int(ID_RE.search(chunk, 0, chunk.find('>') + 1).group(2))
+
+
+def way_refs(chunk):
+    return [int(m.group(2)) for m in ND_RE.finditer(chunk)]
+
+
+def relation_members(chunk):
+    """[(type, ref), ...] of a relation"""
+    members = []
+    for attrs in MEMBER_RE.findall(chunk):
+        member_type = TYPE_RE.search(attrs)
+        member_ref = REF_RE.search(attrs)
+        if member_type and member_ref:
+            members.append((member_type.group(2), int(member_ref.group(2))))
+    return members
+
+
+###
+# OBJECTIVE: selection of the elements, by mode
+###
+def select_every(k):
+    """Predicate keeping every k-th top level element"""
+    return lambda index, tag, chunk: index % k == 0
+
+
+def select_reservoir(osm_file, size, seed=None):
+    """Predicate keeping size elements chosen at random (one pass, algorithm R)"""
+    rng = random.Random(seed)
+    reservoir = []
+    for index, _ in enumerate(iter_raw_elements(osm_file)):
+        if index < size:
+            reservoir.append(index)
+        else:
+            j = rng.randint(0, index)
+            if j < size:
+                reservoir[j] = index
+    chosen = set(reservoir)
+    return lambda index, tag, chunk: index in chosen
+
+
+def select_bbox(osm_file, bbox):
+    """Predicate keeping nodes in bbox, ways using them and relations with
+    a kept member. bbox is (min_lat, min_lon, max_lat, max_lon).
+
+    Nodes come first in an osm file, so the kept ids are known by the time
+    ways and relations are tested. Running it again over the file (second
+    pass of complete=True) gives the same nodes and ways.
+    """
+    min_lat, min_lon, max_lat, max_lon = bbox
+    kept = {'node': set(), 'way': set(), 'relation': set()}
+
+    def keep(index, tag, chunk):
+        if tag == 'node':
+            head = chunk[:chunk.find('>') + 1]
+            lat = LAT_RE.search(head)
+            lon = LON_RE.search(head)
+            inside = (lat is not None and lon is not None and
+                      min_lat <= float(lat.group(2)) <= max_lat and
+                      min_lon <= float(lon.group(2)) <= max_lon)
+        elif tag == 'way':
+            nodes = kept['node']
+            inside = any(ref in nodes for ref in way_refs(chunk))
+        else:
+            inside = any(ref in kept.get(member_type, ())
+                         for member_type, ref in relation_members(chunk))
+        if inside:
+            kept[tag].add(element_id(chunk))
+        return inside
+
+    return keep
+
+
+###
+# OBJECTIVE: write the selected elements to the sample file
+###
+def sample(osm_file, sample_file, keep, complete=False):
+    """Write the elements of osm_file accepted by keep(index, tag, chunk)
+
+    With complete=True a first pass collects the nodes referenced by the
+    kept ways, and they are written as well. Returns the number of
+    elements written.
+    """
+    needed = set()
+    if complete:
+        for index, (tag, chunk) in enumerate(iter_raw_elements(osm_file)):
+            if keep(index, tag, chunk) and tag == 'way':
+                needed.update(way_refs(chunk))
+
+    count = 0
+    with open(sample_file, 'wb', BUFFER_SIZE) as output:
+        output.write(HEADER)
+        for index, (tag, chunk) in enumerate(iter_raw_elements(osm_file)):
+            if keep(index, tag, chunk) or \
+                    (needed and tag == 'node' and element_id(chunk) in needed):
+                output.write(chunk)
+                count += 1
+        output.write(FOOTER)
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create a sample of an osm file')
+    parser.add_argument('osm_file')
+    parser.add_argument('sample_file')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--every', type=int, metavar='K',
+                      help='keep every K-th top level element')
+    mode.add_argument('--reservoir', type=int, metavar='N',
+                      help='keep N elements chosen at random')
+    mode.add_argument('--bbox', metavar='MINLAT,MINLON,MAXLAT,MAXLON',
+                      help='keep what lies inside the bounding box')
+    parser.add_argument('--complete', action='store_true',
+                        help='also keep the nodes of the kept ways')
+    parser.add_argument('--seed', type=int, help='random seed of --reservoir')
+    args = parser.parse_args(argv)
+
+    if args.every:
+        keep = select_every(args.every)
+    elif args.reservoir:
+        keep = select_reservoir(args.osm_file, args.reservoir, args.seed)
+    else:
+        keep = select_bbox(args.osm_file,
+                           [float(x) for x in args.bbox.split(',')])
+
+    count = sample(args.osm_file, args.sample_file, keep, args.complete)
+    print count, "elements written to", args.sample_file
+
+
+if __name__ == "__main__":
+    main()
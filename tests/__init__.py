@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the wrangling pipeline. Run from the repository root with:
+  python -m unittest discover
+"""
+
+import os
+import shutil
+import tempfile
+
+import wrangle
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# every 25th element of the Nanterre sample, with the nodes of its ways
+# (sampler.py --every 25 --complete), and its .osm.pbf copy (DenseNodes)
+SMALL_OSM = os.path.join(DATA_DIR, 'sampleNanterre_small.osm.gz')
+SMALL_PBF = os.path.join(DATA_DIR, 'sampleNanterre_small.osm.pbf')
+
+
+def read_csvs(paths=wrangle.CSV_PATHS):
+    """{path: content} of the csv(s) of the current directory"""
+    contents = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents[path] = f.read()
+    return contents
+
+
+def export_csvs(osm_file, **kwargs):
+    """{path: content} of the csv(s) process_map writes for osm_file
+
+    The export runs in a temporary directory (the csv paths are relative).
+    """
+    osm_file = os.path.abspath(osm_file)
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='wrangle_test_')
+    try:
+        os.chdir(work_dir)
+        wrangle.process_map(osm_file, False, **kwargs)
+        return read_csvs()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
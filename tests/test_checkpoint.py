@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import wrangle
+from tests import SMALL_OSM, read_csvs
+
+
+class Crash(Exception):
+    pass
+
+
+class CheckpointTest(unittest.TestCase):
+    """Kill the export after some checkpoints, resume, compare with a clean run"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp(prefix='wrangle_test_')
+        os.chdir(self.work_dir)
+        # checkpoints need an uncompressed file
+        self.osm_file = os.path.join(self.work_dir, 'small.osm')
+        with open(self.osm_file, 'wb') as f:
+            f.write(gzip.open(SMALL_OSM, 'rb').read())
+        wrangle.process_map(self.osm_file, False)
+        self.expected = read_csvs()
+        for path in wrangle.CSV_PATHS:
+            os.remove(path)
+        self.slack = wrangle.CHECKPOINT_SLACK
+        self.save_checkpoint = wrangle.save_checkpoint
+        self.write_shaped = wrangle.CsvExporter.write_shaped
+
+    def tearDown(self):
+        wrangle.CHECKPOINT_SLACK = self.slack
+        wrangle.save_checkpoint = self.save_checkpoint
+        wrangle.CsvExporter.write_shaped = self.write_shaped
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def crash_after(self, checkpoints, elements):
+        """Crash `elements` elements after the checkpoint number `checkpoints`,
+        in the middle of a row"""
+        saved = [0]
+        written = [0]
+        save_checkpoint = self.save_checkpoint
+        write_shaped = self.write_shaped
+
+        def counting_save(path, state):
+            save_checkpoint(path, state)
+            saved[0] += 1
+
+        def crashing_write(exporter, tag, el):
+            if saved[0] >= checkpoints:
+                written[0] += 1
+                if written[0] > elements:
+                    exporter.files[3].write('123,half,row')
+                    raise Crash()
+            write_shaped(exporter, tag, el)
+
+        wrangle.save_checkpoint = counting_save
+        wrangle.CsvExporter.write_shaped = crashing_write
+
+    def resume(self, checkpoints, elements, rows='dict'):
+        self.crash_after(checkpoints, elements)
+        self.assertRaises(Crash, wrangle.process_map_resumable, self.osm_file, False,
+                          'cp.json', every=100, rows=rows)
+        self.assertTrue(os.path.exists('cp.json'))
+        wrangle.save_checkpoint = self.save_checkpoint
+        wrangle.CsvExporter.write_shaped = self.write_shaped
+        wrangle.process_map(self.osm_file, False, checkpoint='cp.json', rows=rows)
+        self.assertFalse(os.path.exists('cp.json'))
+        actual = read_csvs()
+        for path in wrangle.CSV_PATHS:
+            self.assertEqual(actual[path], self.expected[path], path)
+
+    def test_resume_after_first_checkpoint(self):
+        self.resume(1, 57)
+
+    def test_resume_in_the_ways(self):
+        self.resume(22, 40, rows='tuple')
+
+    def test_resume_with_small_slack(self):
+        # the resumed parse starts too late and goes back
+        wrangle.CHECKPOINT_SLACK = 1000
+        self.resume(10, 0)
+
+    def test_resume_unsorted(self):
+        # the last node first, as in Overpass "out qt" output
+        with open(self.osm_file, 'rb') as f:
+            data = f.read()
+        first = data.index('<node ')
+        way = data.index('<way ')
+        last = data.rindex('<node ', 0, way)
+        with open(self.osm_file, 'wb') as f:
+            f.write(data[:first] + data[last:way] + data[first:last] + data[way:])
+        wrangle.process_map(self.osm_file, False)
+        self.expected = read_csvs()
+        self.resume(2, 50)
+
+    def test_missing_csv(self):
+        self.crash_after(3, 10)
+        self.assertRaises(Crash, wrangle.process_map_resumable, self.osm_file, False,
+                          'cp.json', every=100)
+        wrangle.CsvExporter.write_shaped = self.write_shaped
+        os.remove(wrangle.WAY_NODES_PATH)
+        wrangle.process_map(self.osm_file, False, checkpoint='cp.json')
+        actual = read_csvs()
+        for path in wrangle.CSV_PATHS:
+            self.assertEqual(actual[path], self.expected[path], path)
+
+
+if __name__ == '__main__':
+    unittest.main()
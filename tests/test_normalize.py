@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import wrangle
+from tests import SMALL_OSM, export_csvs
+
+PHONES = ['', ';', ' ', '0', '00', '0033', '+33', '0123', '3615', '15', '112',
+          '01 47 21 00 00', '01.47.21.00.00', '+33 (0)1 47 21 00 00',
+          '0033147210000', '0612345678912345', '01 47 21 00 00;06 12 34 56 78',
+          u'01 47 21 00 00', u'é', u'01é47', u'tél : 01 47 21 00 00', u';',
+          u'01 47 21 00 00', '\x00', '01\x0047']
+HOUSENUMBERS = ['', '-', ',;', '1', '12', '3B', '3 bis', '4ter', '5 T', '12Q', '9 b',
+                '1-3', '1,3;5', '10-12B', 'Appt 3', u'2²', u'7 Quater', u'3 bis',
+                u'12 ème', u'٣', 'B']
+
+
+def random_values(rng, alphabet, count, size):
+    values = []
+    for _ in range(count):
+        chars = [rng.choice(alphabet) for _ in range(rng.randint(0, size))]
+        if any(isinstance(c, unicode) for c in chars):
+            values.append(u''.join(c if isinstance(c, unicode) else c.decode('latin-1')
+                                   for c in chars))
+        else:
+            values.append(''.join(chars))
+    return values
+
+
+class BatchNormalizeTest(unittest.TestCase):
+    """normalize_phones and normalize_housenumbers give the results of the
+    scalar cleaners, value for value and type for type"""
+
+    def setUp(self):
+        rng = random.Random(1)
+        self.phones = PHONES + random_values(
+            rng, list('0123456789') * 4 + list('+ .-()/;aZ\t') +
+            [u'é', u'–', '\xc3', '\x00'], 20000, 20)
+        self.housenumbers = HOUSENUMBERS + random_values(
+            rng, list('0123456789 BTQbisterQuat,;-') + [u'è', u'²'], 20000, 8)
+        self.np = wrangle.np
+
+    def tearDown(self):
+        wrangle.np = self.np
+
+    def assert_same(self, values, batch, scalar):
+        self.assertEqual(len(batch), len(values))
+        for value, actual, expected in zip(values, batch, scalar):
+            self.assertEqual((type(actual), actual), (type(expected), expected),
+                             repr(value))
+
+    def check_phones(self):
+        # clean_phone.func: the LRU cache answers u'01' with the result of '01'
+        self.assert_same(self.phones, wrangle.normalize_phones(self.phones),
+                         [wrangle.clean_phone.func(value) for value in self.phones])
+
+    def test_phones_numpy(self):
+        if wrangle.np is None:
+            self.skipTest("numpy is not installed")
+        self.check_phones()
+
+    def test_phones_without_numpy(self):
+        wrangle.np = None
+        self.check_phones()
+
+    def test_phones_short_column(self):
+        # fewer than NUMPY_BATCH_MIN values
+        self.assert_same(PHONES, wrangle.normalize_phones(PHONES),
+                         [wrangle.clean_phone.func(value) for value in PHONES])
+
+    def test_housenumbers(self):
+        scalar = [';'.join([wrangle.update_housenb(item, wrangle.bis_ter_quater)
+                            for item in wrangle.HOUSENB_SPLIT_RE.split(value) if item])
+                  for value in self.housenumbers]
+        self.assert_same(self.housenumbers,
+                         wrangle.normalize_housenumbers(self.housenumbers), scalar)
+        self.assertEqual(scalar, [wrangle.clean_housenumber(value)
+                                  for value in self.housenumbers])
+
+
+class PipelinedBatchCleanTest(unittest.TestCase):
+    """The pipelined export, which cleans per batch, writes the csv(s) of
+    the sequential one"""
+
+    def assert_same_csvs(self, osm_file):
+        expected = export_csvs(osm_file)
+        for rows in ('dict', 'tuple'):
+            actual = export_csvs(osm_file, pipelined=True, rows=rows)
+            for path in wrangle.CSV_PATHS:
+                self.assertEqual(actual[path], expected[path], path)
+
+    def test_sample(self):
+        self.assert_same_csvs(SMALL_OSM)
+
+    def test_keys_classified_like_cleaned_ones(self):
+        # regular:phone is shaped as key phone, type regular, but not cleaned
+        work_dir = tempfile.mkdtemp(prefix='wrangle_test_')
+        try:
+            osm_file = os.path.join(work_dir, 'phones.osm')
+            with open(osm_file, 'wb') as f:
+                f.write('<osm><node id="1" lat="48.9" lon="2.2" user="u" uid="1" '
+                        'version="1" changeset="1" timestamp="2017-01-01T00:00:00Z">'
+                        '<tag k="regular:phone" v="01 47 21 00 00"/>'
+                        '<tag k="phone" v="01 47 21 00 00"/>'
+                        '<tag k="addr:housenumber" v="3B"/></node></osm>')
+            self.assert_same_csvs(osm_file)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
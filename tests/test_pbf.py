@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import pbf
+import wrangle
+from tests import SMALL_OSM, SMALL_PBF, export_csvs
+
+
+class PbfTest(unittest.TestCase):
+    """The .osm.pbf copy of the sample exports to the same csv(s) as its xml"""
+
+    def test_elements(self):
+        with pbf.PbfReader(SMALL_PBF, processes=1) as reader:
+            tags = [element.tag for element in reader]
+        self.assertEqual(tags.count('node'), 2093)
+        self.assertEqual(tags.count('way'), 301)
+        self.assertEqual(tags.count('relation'), 3)
+
+    def test_same_csvs_as_xml(self):
+        expected = export_csvs(SMALL_OSM)
+        for rows in ('dict', 'tuple'):
+            actual = export_csvs(SMALL_PBF, rows=rows)
+            for path in wrangle.CSV_PATHS:
+                self.assertEqual(actual[path], expected[path], path)
+
+    def test_decoder_processes(self):
+        # blobs decoded in worker processes come back in file order
+        with pbf.PbfReader(SMALL_PBF, processes=1) as reader:
+            expected = [(e.tag, e.attrib['id']) for e in reader]
+        with pbf.PbfReader(SMALL_PBF, processes=2) as reader:
+            self.assertEqual([(e.tag, e.attrib['id']) for e in reader], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import wrangle
+from tests import SMALL_OSM
+
+
+class ProcessMapOptionsTest(unittest.TestCase):
+    """Options that do not apply together raise instead of being ignored"""
+
+    def assert_rejected(self, **kwargs):
+        self.assertRaises(ValueError, wrangle.process_map, SMALL_OSM, False, **kwargs)
+
+    def test_pipelined(self):
+        self.assert_rejected(pipelined=True, processes=2)
+        self.assert_rejected(pipelined=True, db_path='OSM.db')
+        self.assert_rejected(pipelined=True, columns_dir='columns')
+
+    def test_rows(self):
+        self.assert_rejected(rows='tuple', db_path='OSM.db')
+        self.assert_rejected(rows='tuple', columns_dir='columns')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import sampler
+from tests import DATA_DIR
+
+# JOSM writes single quoted attributes
+JOSM_OSM = os.path.join(DATA_DIR, 'josm_small.osm')
+
+
+class SamplerQuotesTest(unittest.TestCase):
+    """The bbox and complete modes read single quoted attributes as well as
+    double quoted ones"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='sampler_test_')
+        with open(JOSM_OSM, 'rb') as f:
+            single = f.read()
+        self.files = {'single': JOSM_OSM,
+                      'double': os.path.join(self.work_dir, 'double.osm')}
+        with open(self.files['double'], 'wb') as f:
+            f.write(single.replace("'", '"'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def sample_ids(self, osm_file, keep, complete=False):
+        """[(tag, id), ...] of the elements sampled from osm_file"""
+        sample_file = os.path.join(self.work_dir, 'sample.osm')
+        sampler.sample(osm_file, sample_file, keep, complete)
+        return [(tag, sampler.element_id(chunk))
+                for tag, chunk in sampler.iter_raw_elements(sample_file)]
+
+    def test_attributes(self):
+        for quotes, osm_file in self.files.items():
+            chunks = list(sampler.iter_raw_elements(osm_file))
+            self.assertEqual([sampler.element_id(chunk) for _, chunk in chunks],
+                             [-1, 2, 3, 4, 5], quotes)
+            self.assertEqual(sampler.way_refs(chunks[3][1]), [-1, 2], quotes)
+            self.assertEqual(sampler.relation_members(chunks[4][1]),
+                             [('way', 4)], quotes)
+
+    def test_bbox(self):
+        for quotes, osm_file in self.files.items():
+            keep = sampler.select_bbox(osm_file, (48, 2, 49, 3))
+            self.assertEqual(self.sample_ids(osm_file, keep),
+                             [('node', -1), ('node', 2), ('way', 4),
+                              ('relation', 5)], quotes)
+
+    def test_complete(self):
+        for quotes, osm_file in self.files.items():
+            keep = sampler.select_every(3)
+            self.assertEqual(self.sample_ids(osm_file, keep, complete=True),
+                             [('node', -1), ('node', 2), ('way', 4)], quotes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import wrangle
+from tests import SMALL_OSM
+
+
+def way_boxes(db_path):
+    db = sqlite3.connect(db_path)
+    try:
+        return sorted(db.execute("SELECT * FROM ways_rtree"))
+    finally:
+        db.close()
+
+
+class SpatialIndexUpdateTest(unittest.TestCase):
+    """The R*Tree tables follow apply_change"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='wrangle_test_')
+        self.db_path = os.path.join(self.work_dir, 'OSM.db')
+        wrangle.process_map(SMALL_OSM, False, db_path=self.db_path, spatial=True)
+        db = sqlite3.connect(self.db_path)
+        self.node = db.execute(
+            """SELECT n.id, n.version, n.changeset, n.timestamp FROM nodes n
+            JOIN ways_nodes wn ON wn.node_id = n.id LIMIT 1""").fetchone()
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def change(self, action, lat, lon):
+        node_id, version, changeset, timestamp = self.node
+        return StringIO(
+            '<osmChange version="0.6"><%s><node id="%d" version="%d" changeset="%d" '
+            'timestamp="%s" uid="1" user="u" lat="%s" lon="%s"/></%s></osmChange>'
+            % (action, node_id, int(version) + 1, int(changeset), timestamp,
+               lat, lon, action))
+
+    def assert_way_boxes_rebuilt(self):
+        updated = way_boxes(self.db_path)
+        wrangle.build_spatial_index(self.db_path)
+        self.assertEqual(updated, way_boxes(self.db_path))
+
+    def test_moved_node(self):
+        with wrangle.SqliteUpdater(self.db_path) as updater:
+            for action, element in wrangle.iter_changes(self.change('modify', 49.5, 2.9)):
+                updater.apply(action, element)
+        self.assert_way_boxes_rebuilt()
+        with wrangle.SpatialIndex(self.db_path) as index:
+            ways = index.bbox(49.4, 2.8, 49.6, 3.0, types=('way',))
+        self.assertTrue(ways)
+
+    def test_deleted_node(self):
+        with wrangle.SqliteUpdater(self.db_path) as updater:
+            for action, element in wrangle.iter_changes(self.change('delete', 49.5, 2.9)):
+                updater.apply(action, element)
+        self.assert_way_boxes_rebuilt()
+
+
+class SpatialIndexExportTest(unittest.TestCase):
+
+    def test_export_drops_old_index(self):
+        work_dir = tempfile.mkdtemp(prefix='wrangle_test_')
+        try:
+            db_path = os.path.join(work_dir, 'OSM.db')
+            wrangle.process_map(SMALL_OSM, False, db_path=db_path, spatial=True)
+            wrangle.process_map(SMALL_OSM, False, db_path=db_path)
+            db = sqlite3.connect(db_path)
+            try:
+                self.assertFalse(wrangle.has_spatial_index(db))
+            finally:
+                db.close()
+            self.assertRaises(ValueError, wrangle.SpatialIndex, db_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,16 +5,84 @@ Created on Wed Aug 16 17:26:14 2017
 @author: Mamadou DIALLO
 """
 
+import abc
+import bisect
 import csv
-import codecs
+import gzip
+import hashlib
+import os
 import pprint
 import re
+import shutil
+import sqlite3
+import string
+import struct
+import sys
+import tempfile
+import threading
+import time
+import json
+import math
+import mmap
+import multiprocessing
+import operator
+import Queue
 import xml.etree.cElementTree as ET
+from array import array
 from collections import defaultdict
+from contextlib import closing
 import cerberus
 import schema
+import osmio
+import pbf
+
+# optional: the columnar export and the batch normalizers use numpy
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# relations are not part of schema.Schema: same rules as the way tables
+RELATION_SCHEMA = {
+    'relation': {
+        'type': 'dict',
+        'schema': {
+            'id': {'required': True, 'type': 'integer', 'coerce': int},
+            'user': {'required': True, 'type': 'string'},
+            'uid': {'required': True, 'type': 'integer', 'coerce': int},
+            'version': {'required': True, 'type': 'string'},
+            'changeset': {'required': True, 'type': 'integer', 'coerce': int},
+            'timestamp': {'required': True, 'type': 'string'}
+        }
+    },
+    'relation_members': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'required': True, 'type': 'integer', 'coerce': int},
+                'type': {'required': True, 'type': 'string'},
+                'ref': {'required': True, 'type': 'integer', 'coerce': int},
+                'role': {'required': True, 'type': 'string'},
+                'position': {'required': True, 'type': 'integer', 'coerce': int}
+            }
+        }
+    },
+    'relation_tags': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'required': True, 'type': 'integer', 'coerce': int},
+                'key': {'required': True, 'type': 'string'},
+                'value': {'required': True, 'type': 'string'},
+                'type': {'required': True, 'type': 'string'}
+            }
+        }
+    }
+}
 
-SCHEMA = schema.Schema
+SCHEMA = dict(schema.Schema, **RELATION_SCHEMA)
 
 OSM_PATH = "Nanterre.osm"
 SAMPLE_PATH = "SampleNanterre.osm"
@@ -23,6 +91,15 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
+CSV_PATHS = (NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH,
+             RELATIONS_PATH, RELATION_MEMBERS_PATH, RELATION_TAGS_PATH)
+DB_PATH = "OSM.db"
+
+# top level elements written by process_map
+EXPORT_TAGS = ('node', 'way', 'relation')
 
 # Make sure the fields order in the csvs matches 
 # the column order in the sql table schema
@@ -31,6 +108,13 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_MEMBERS_FIELDS = ['id', 'type', 'ref', 'role', 'position']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+# fields of each file of CSV_PATHS
+CSV_FIELDS = (NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS,
+              WAY_TAGS_FIELDS, RELATION_FIELDS, RELATION_MEMBERS_FIELDS,
+              RELATION_TAGS_FIELDS)
 
 # Pattern 1: lower case
 LOWER = re.compile(r'^([a-z]|_)*$')
@@ -93,17 +177,13 @@ house_numbers = defaultdict(int)
 # OBJECTIVE: Parse first Elements of the file
 ##                      
 def parse_firtElements(filename):
-    tree = ET.parse(filename)
-    root = tree.getroot()
-    count = 0
+    # streamed: only the first elements are kept, not the whole tree
+    first = audit_map(filename, [FirstElementsAudit(10)])[0]
     print "root:"
-    print root.tag, root.attrib
+    print first['root'][0], first['root'][1]
 
-    for child in root:
-        print count, ":",child.tag, child.attrib
-        if count == 10:
-            break
-        count +=1
+    for count, (tag, attrib) in enumerate(first['elements']):
+        print count, ":", tag, attrib
 
 ###
 # OBJECTIVE: 
@@ -111,38 +191,81 @@ def parse_firtElements(filename):
 # find out not only what tags are there, but also how many, to get the
 # feeling on how much of which data you can expect to have in the map.
 ###
-def count_tags(filename):
-        # The Dictionary of the tag list in input file.
-        # Initialisation
-        tagsList = {}
-        # scan input file
-        with open(filename, "r") as f:
-            # for each line
-            for line in f:
-                try:
-                    val = line.split()[0]
-                    # we do not consider the header
-                    if line.startswith("<?xml"):
-                        continue
-                    # we do not consider the closing tag
-                    elif val.startswith('</'):
-                        continue
-                    # get the tag
-                    elif val.startswith('<'):
-                        # get the tag name
-                        tg = val.split('<')[1]
-                        # count tag name if it already exits
-                        if tg in tagsList:
-                            tagsList[tg] += 1
-                        # create the tag name when met the first time
-                        # count set to 1
-                        else:
-                            tagsList[tg] = 1
-
-                except ValueError:
-                    continue
+# start of an element: <node, <tag... (not </, <? or <!)
+START_TAG_RE = re.compile(r'<([A-Za-z_][^\s/>]*)')
+# k and v of a <tag/>, in double (osmosis, overpass) or single quotes (JOSM)
+TAG_KV_RE = re.compile(r"""<tag\s+k=(["'])(.*?)\1\s+v=(["'])(.*?)\3""")
+STATS_BLOCK_SIZE = 1 << 23
+
+
+def iter_markup_blocks(filename, block_size=STATS_BLOCK_SIZE):
+    """Yield large blocks of the file, each cut before a '<'
+
+    '<' is always escaped in attribute values and text, so no start tag
+    is ever split between two blocks, whatever the line layout.
+    """
+    with closing(osmio.open_osm(filename)) as f:
+        rest = ''
+        while True:
+            block = f.read(block_size)
+            if not block:
+                if rest:
+                    yield rest
+                return
+            buf = rest + block
+            cut = buf.rfind('<')
+            if cut <= 0:
+                rest = buf
+                continue
+            yield buf[:cut]
+            rest = buf[cut:]
+
+
+def tag_statistics(filename, values=True):
+    """Element and tag key statistics of an osm file, by regex scanning
+
+    Returns {'elements': {name: count}, 'keys': {key: count},
+    'cardinality': {key: number of distinct values}}. Nothing is parsed:
+    the file is read in large blocks (compressed files too) and scanned
+    with two compiled regexes. values=False skips the distinct values,
+    which is the only part growing with the data.
+    """
+    elements = defaultdict(int)
+    keys = defaultdict(int)
+    key_values = defaultdict(set)
+    if pbf.is_pbf(filename):
+        # no xml to scan: count the decoded elements
+        elements['osm'] += 1
+        for element in pbf.PbfReader(filename):
+            for elem in element.iter():
+                elements[elem.tag] += 1
+                if elem.tag == 'tag':
+                    keys[elem.attrib['k']] += 1
+                    if values:
+                        key_values[elem.attrib['k']].add(elem.attrib['v'])
+    else:
+        for block in iter_markup_blocks(filename):
+            names = START_TAG_RE.findall(block)
+            # a handful of names: one C level count() per name
+            for name in set(names):
+                elements[name] += names.count(name)
+            if values:
+                for _, k, _, v in TAG_KV_RE.findall(block):
+                    keys[k] += 1
+                    key_values[k].add(v)
+            else:
+                for _, k, _, _ in TAG_KV_RE.findall(block):
+                    keys[k] += 1
+    return {'elements': dict(elements),
+            'keys': dict(keys),
+            'cardinality': dict((k, len(v)) for k, v in key_values.iteritems())}
+
 
-        return tagsList
+def count_tags(filename):
+    # The Dictionary of the tag list in input file.
+    # block scan instead of one split() per line: exact on minified xml
+    # and on lines holding several elements
+    return tag_statistics(filename, values=False)['elements']
 
 
 ###
@@ -177,14 +300,7 @@ def audit_house_number(filename):
     # multiple housenumber are separated by coma... need to check each individuals one against 
     # the housenumber regular expression. As Appt keyword could be followed by a list numbers separated by a coma
     # a first check for any housenumber starting with Appt will done before the other split and check
-    house_numbers = defaultdict(set)
-    for event, elem in ET.iterparse(filename, events=("start",)):
-            if elem.tag == "node" or elem.tag == "way":
-                  for tag in elem.iter("tag"):
-                      if is_house_number(tag):
-                          audit_house_number_type(house_numbers, tag.attrib['v'])
-    
-    return house_numbers
+    return audit_map(filename, [HouseNumberAudit()])[0]
 
 
 ###
@@ -250,50 +366,29 @@ def audit_street_type(street_types, street_name):
 # OBJECTIVE: audit street types for each element
 ###        
 def auditStreetType(filename):
-    osm_file = open(filename, "r")
-    street_types = defaultdict(set)
-    #for event, elem in ET.iterparse(osm_file):
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-
-    osm_file.close()
-    return street_types
+    return audit_map(filename, [StreetTypeAudit()])[0]
 
 ###
 #OBJECTIVE: audit phone numbers
 ###        
 def audit_phone(filename):
-      phone_len = defaultdict(list)
-
-      for event, elem in ET.iterparse(filename, events=("start",)):
-            if elem.tag == "node" or elem.tag == "way":
-                  for tag in elem.iter("tag"):
-                        key = tag.attrib['k']
-                        if key == 'phone':
-                              phone_num = re.sub(r'[\+\(\)\-\s]', '', tag.attrib['v'])
-                              phone_len[len(phone_num)].append(tag.attrib['v'])
-
-      return phone_len
+    return audit_map(filename, [PhoneAudit()])[0]
 
 
 ###
 # OBJECTIVE: update phone numbers
 ### 
+# only letters, digits, '+' and ';' are kept (spaces and separators dropped)
+PHONE_WHITELIST = string.ascii_letters + string.digits + '+;'
+PHONE_DELETE = ''.join(c for c in map(chr, range(256)) if c not in PHONE_WHITELIST)
+PHONE_DELETE_RE = re.compile(r'[^A-Za-z0-9+;]')
+
 def update_phone(phone_num):
-    import string
-    whitelist = string.letters + string.digits + ' ' + '+'+';'
-    new_s = ''
-    for char in phone_num:
-        if char == ' ':
-            new_s += ''
-        elif char in whitelist:
-            new_s += char
-        else:
-            new_s += ''
-    new_s = new_s.strip()
+    # single pass over the characters
+    if isinstance(phone_num, unicode):
+        new_s = PHONE_DELETE_RE.sub(u'', phone_num) or ''
+    else:
+        new_s = phone_num.translate(None, PHONE_DELETE)
     if new_s[:4]=='0033':
         new_s = '+33'+new_s[4:]
     elif new_s[:1]=='0':
@@ -302,24 +397,11 @@ def update_phone(phone_num):
     # change format for readability
     if len(new_s) == 4:
         # special phone numbers
-        phone_num_parts = []
-        phone_num_parts.append(new_s)
-        return ''.join(phone_num_parts) 
+        return new_s
     else:
-        # regular phone numbers
-        phone_num_parts = []
-        phone_num_parts.append(new_s[:3])
-        phone_num_parts.append(' ')
-        phone_num_parts.append(new_s[3:4])
-        phone_num_parts.append(' ')
-        phone_num_parts.append(new_s[4:6])
-        phone_num_parts.append(' ')
-        phone_num_parts.append(new_s[6:8])
-        phone_num_parts.append(' ')
-        phone_num_parts.append(new_s[8:10])
-        phone_num_parts.append(' ')
-        phone_num_parts.append(new_s[10:12])
-        return ''.join(phone_num_parts)   
+        # regular phone numbers: +33 N NN NN NN NN
+        return ' '.join((new_s[:3], new_s[3:4], new_s[4:6],
+                         new_s[6:8], new_s[8:10], new_s[10:12]))
         
 ###
 # PURPOSE: count of empty values, leading or trailing space 
@@ -360,191 +442,500 @@ def is_empty(elem):
 # PURPOSE: audit empty values, leading or trailing space  
 ###
 def auditEmptyValues(filename):
-    keys = {"empty": 0,"not_empty":0,"leading_trailing":0}
-    for _, element in ET.iterparse(filename):
-        keys = empty_value(element, keys)
-
-    return keys
+    return audit_map(filename, [EmptyValuesAudit()])[0]
 
   
 ###
-# PURPOSE  
+# PURPOSE: cleaning functions applied to the value of a tag, by tag key
 ###
-def shape_element(element, node_attr_fields=NODE_FIELDS, \
-                  way_attr_fields=WAY_FIELDS,\
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
+HOUSENB_SPLIT_RE = re.compile(r"[,;\-]+")
 
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
+###
+# PURPOSE: bounded least recently used cache for the value normalizers
+###
+NORMALIZER_CACHE_SIZE = 50000
+
+class LRUCache(object):
+    """Memoize func(value), keeping the maxsize most recently used values
+
+    OSM repeats the same street names, house numbers and phone numbers on
+    many elements, so most calls are answered from the cache. hits and
+    misses are counted for stats(); maxsize=0 disables the cache.
+    """
+    PREV, NEXT, KEY, RESULT = 0, 1, 2, 3
+
+    def __init__(self, func, maxsize=NORMALIZER_CACHE_SIZE):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        self.cache = {}
+        # circular doubly linked list, oldest entry after the root
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.hits = self.misses = 0
+
+    def __call__(self, value):
+        link = self.cache.get(value)
+        root = self.root
+        if link is not None:
+            self.hits += 1
+            # move link to the most recently used end
+            link_prev, link_next = link[0], link[1]
+            link_prev[1] = link_next
+            link_next[0] = link_prev
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            return link[3]
+
+        self.misses += 1
+        result = self.func(value)
+        if self.maxsize > 0:
+            if len(self.cache) >= self.maxsize:
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self.cache[oldest[2]]
+            last = root[0]
+            link = [last, root, value, result]
+            last[1] = root[0] = self.cache[value] = link
+        return result
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits) / calls if calls else 0.0,
+                'size': len(self.cache), 'maxsize': self.maxsize}
+
+
+def lru_cache(maxsize=NORMALIZER_CACHE_SIZE):
+    """Decorator wrapping a one argument function in an LRUCache"""
+    def decorator(func):
+        return LRUCache(func, maxsize)
+    return decorator
+
+
+@lru_cache()
+def clean_street(value):
+    return update_name(value, mapping)
+
+@lru_cache()
+def clean_housenumber(value):
+    # multiple house numbers are separated by ',', ';' or '-'
+    return ';'.join([update_housenb(item, bis_ter_quater)
+                     for item in HOUSENB_SPLIT_RE.split(value) if item])
+
+@lru_cache()
+def clean_phone(value):
+    # multiple phone numbers are separated by ';'
+    return ';'.join([update_phone(item) for item in value.split(';')])
+
+NORMALIZER_CACHES = (clean_street, clean_housenumber, clean_phone)
+
+def set_cache_size(maxsize):
+    """Resize (and empty) the caches of the value normalizers"""
+    for cache in NORMALIZER_CACHES:
+        cache.maxsize = maxsize
+        cache.clear()
+
+def cache_stats():
+    """Hit/miss statistics of the value normalizer caches"""
+    return dict((cache.__name__, cache.stats()) for cache in NORMALIZER_CACHES)
+
+# Registry: tag key -> cleaning function. Add an entry to clean a new key;
+# the cost per tag stays one dict lookup whatever the number of cleaners.
+TAG_CLEANERS = {
+    'addr:street': clean_street,
+    'addr:housenumber': clean_housenumber,
+    'phone': clean_phone,
+    'contact:phone': clean_phone,
+    'contact:mobile': clean_phone,
+}
 
-    # YOUR CODE HERE
-    count = 0
-    data = {}
-    dt = {}
-    if element.tag == 'node':
-        node_attribs['id'] = element.attrib['id']
-        node_attribs['lat'] = element.attrib['lat']
-        node_attribs['lon'] = element.attrib['lon']
-        node_attribs['user'] = element.attrib['user']
-        node_attribs['uid'] = element.attrib['uid']
-        node_attribs['version'] = element.attrib['version']
-        node_attribs['changeset'] = element.attrib['changeset']
-        node_attribs['timestamp'] = element.attrib['timestamp']
-        #print "node_attribs:"
-        #pprint.pprint(node_attribs)
-        
-        for sub in element:
-            if sub.tag == 'tag':
-                data = {
-                    "id": None,
-                    "key": None,
-                    "value": None,
-                    "type": None
-                }                
-                data["id"] = node_attribs['id']
-                data["value"] = sub.attrib['v']
-                str = sub.attrib['k']
-                ret = is_empty(sub)
-                if ret == 1:
-                    #Correct leading or trailing space in value for element
-                    data["value"] = data["value"].strip()                    
-                elif ret == 2:
-                    # empty tag to be skipped
-                    continue                                    
-                if is_street_name(sub):
-                    #name = data["value"].upper()
-                    name = data["value"]
-                    better_name = update_name(name,mapping)
-                    data["value"] = better_name
-                elif is_house_number(sub):
-                    nb = data["value"]
-                    lst = filter(None, re.split("[,;\-]+", nb))
-                    s = []
-                    for item in lst:
-                        s.append(update_housenb(item, bis_ter_quater))
-                    better_nb = ';'.join(s)
-                    data["value"] = better_nb
-                elif is_phone(sub):
-                    phone = data["value"]
-                    lst = phone.split(';')
-                    s = []
-                    for item in lst:
-                        s.append(update_phone(item))
-                    ph = ';'.join(s)
-                    data["value"] = ph
-                        
-                        
-                if re.search(PROBLEMCHARS, str) != None:
-                    print "PROBLEMS node_attribs:"
-                    pprint.pprint(node_attribs)
-                    continue
-                elif re.search(LOWER_COLON, str) != None:
-                    data["type"] = str.split(":")[0]
-                    data["key"] = ":".join(str.split(":")[1:])
-                else:
-                    data["type"] = "regular"
-                    data["key"] = str
+###
+# PURPOSE: normalize a whole column of values at once
+###
+# numpy pays off from about this many numbers
+NUMPY_BATCH_MIN = 1000
+# where the 12 chars of '+33N...' go in '+33 N NN NN NN NN' (-1: spaces)
+PHONE_LAYOUT = [0, 1, 2, -1, 3, -1, 4, 5, -1, 6, 7, -1, 8, 9, -1, 10, 11]
+
+
+def _normalize_phone_items(items):
+    """[update_phone(item) for item in items], on a numpy byte matrix
+
+    The separators are deleted with the PHONE_DELETE translation table
+    (unicode items are utf-8 encoded first: their non-ascii chars are
+    made of non-ascii bytes, all deleted). Then every number is a row of
+    bytes and replacing the 0033 or 0 prefix and formatting are done on
+    all the rows at once; numbers shorter than 12 chars leave holes in
+    the formatted rows that are squeezed out, as ' '.join leaves empty
+    parts. Without numpy, or for fewer than NUMPY_BATCH_MIN items, the
+    items go through update_phone one by one.
+    """
+    if np is None or len(items) < NUMPY_BATCH_MIN:
+        return [update_phone(item) for item in items]
+    deleted = [_utf8(item).translate(None, PHONE_DELETE) for item in items]
+    n = len(deleted)
+    chars = np.array(deleted, dtype='S')
+    width = chars.dtype.itemsize
+    # room to shift the body when the prefix is replaced
+    m = np.zeros((n, width + 12), np.uint8)
+    m[:, :width] = chars.view(np.uint8).reshape(n, width)
+    lengths = (m != 0).sum(1)
+
+    prefixed = m[:, 0] == ord('0')
+    intl = prefixed & (m[:, 1] == ord('0')) & (m[:, 2] == ord('3')) & (m[:, 3] == ord('3'))
+    drop = np.where(intl, 4, prefixed.astype(int))
+    body_width = width + 8
+    number = np.zeros((n, body_width + 3), np.uint8)
+    number[~prefixed, :body_width] = m[~prefixed, :body_width]
+    number[prefixed, :3] = np.frombuffer(b'+33', np.uint8)
+    number[prefixed & ~intl, 3:] = m[prefixed & ~intl, 1:body_width + 1]
+    number[intl, 3:] = m[intl, 4:body_width + 4]
+    number_lengths = lengths - drop + 3 * prefixed
+
+    layout = np.array(PHONE_LAYOUT)
+    formatted = number[:, np.maximum(layout, 0)]
+    formatted[:, layout < 0] = ord(' ')
+    short = number_lengths < 12
+    order = np.argsort(formatted[short] == 0, axis=1, kind='mergesort')
+    formatted[short] = np.take_along_axis(formatted[short], order, 1)
+
+    special = number_lengths == 4
+    results = np.ascontiguousarray(formatted).view('S%d' % len(PHONE_LAYOUT)).ravel()
+    results[special] = np.ascontiguousarray(number[special]).view(
+        'S%d' % (body_width + 3)).ravel()
+    results = results.tolist()
+    for i, item in enumerate(items):
+        # update_phone keeps unicode unicode, unless nothing is left of it
+        if item.__class__ is unicode and lengths[i]:
+            results[i] = results[i].decode('ascii')
+    return results
+
+
+def normalize_phones(values):
+    """[clean_phone(value) for value in values], in one go
+
+    Each distinct value is split once, and the numbers of all of them
+    are normalized together (on numpy arrays when numpy is installed).
+    """
+    # keyed by class too: u'01' == '01', but they are cleaned to u'...' and '...'
+    distinct = dict.fromkeys((value.__class__, value) for value in values).keys()
+    items = []
+    spans = []
+    for cls, value in distinct:
+        parts = value.split(';')
+        spans.append((len(items), len(items) + len(parts)))
+        items.extend(parts)
+    results = _normalize_phone_items(items)
+    cleaned = dict((key, ';'.join(results[start:end]))
+                   for key, (start, end) in zip(distinct, spans))
+    return [cleaned[(value.__class__, value)] for value in values]
+
+
+def normalize_housenumbers(values):
+    """[clean_housenumber(value) for value in values], in one go
+
+    Each distinct value is split once and each distinct house number
+    cleaned once; plain numbers (most of them) are returned as they are
+    without running the regex, update_housenb would leave them unchanged.
+    """
+    # keyed by class too, as in normalize_phones
+    cleaned_items = {}
+    cleaned = {}
+    for value in values:
+        key = (value.__class__, value)
+        if key in cleaned:
+            continue
+        items = [(item.__class__, item) for item in HOUSENB_SPLIT_RE.split(value) if item]
+        for item_key in items:
+            if item_key not in cleaned_items:
+                item = item_key[1]
+                cleaned_items[item_key] = (item if item.isdigit() else
+                                           update_housenb(item, bis_ter_quater))
+        cleaned[key] = ';'.join([cleaned_items[item_key] for item_key in items])
+    return [cleaned[(value.__class__, value)] for value in values]
+
+# cleaner of TAG_CLEANERS -> batch version of it
+BATCH_CLEANERS = {
+    clean_phone: normalize_phones,
+    clean_housenumber: normalize_housenumbers,
+}
+
+###
+# PURPOSE: classify a tag key once: problem chars, type:key or regular
+###
+KEY_CACHE_SIZE = 100000
+_key_cache = {}
+
+def classify_key(k):
+    """Return (type, key) for a tag key, None if it has problem chars
+
+    type is None for a regular key. Results are cached per distinct key
+    string (up to KEY_CACHE_SIZE keys).
+    """
+    try:
+        return _key_cache[k]
+    except KeyError:
+        pass
+    if PROBLEMCHARS.search(k) is not None:
+        result = None
+    elif LOWER_COLON.search(k) is not None:
+        tag_type, key = k.split(":", 1)
+        result = (tag_type, key)
+    else:
+        result = (None, k)
+    if len(_key_cache) < KEY_CACHE_SIZE:
+        _key_cache[k] = result
+    return result
+
+
+###
+# PURPOSE: clean and shape the tag children of a node or a way
+###
+# tags stripped, cleaned or dropped by shape_tags since the start
+TAG_COUNTERS = defaultdict(int)
+
+def iter_clean_tags(element, attribs, default_tag_type='regular', deferred=None):
+    """Yield (key, value, type) of the cleaned tags of element, skipping
+    empty values and keys with problem chars
+
+    With deferred (a list), the values of the cleaners of BATCH_CLEANERS
+    are yielded raw and (position, k, cleaner) of each of them appended
+    to deferred, position being the index of the tag among the yielded
+    ones: the caller cleans them (see PipelinedCsvExporter).
+    """
+    position = 0
+    for sub in element:
+        if sub.tag != 'tag':
+            continue
+        attrib = sub.attrib
+        # leading or trailing space is removed, empty tags are skipped
+        raw = attrib['v']
+        value = raw.strip()
+        if not value:
+            TAG_COUNTERS['dropped_empty'] += 1
+            continue
+        if value != raw:
+            TAG_COUNTERS['stripped'] += 1
+        k = attrib['k']
+        kind = classify_key(k)
+        if kind is None:
+            TAG_COUNTERS['dropped_problemchars'] += 1
+            print "PROBLEMS node_attribs:"
+            pprint.pprint(attribs)
+            continue
+        cleaner = TAG_CLEANERS.get(k)
+        if cleaner is not None:
+            if deferred is not None and cleaner in BATCH_CLEANERS:
+                deferred.append((position, k, cleaner))
+            else:
+                cleaned = cleaner(value)
+                if cleaned != value:
+                    TAG_COUNTERS['cleaned'] += 1
+                    value = cleaned
+        position += 1
+        yield kind[1], value, kind[0] or default_tag_type
+
+
+def shape_tags(element, attribs, default_tag_type='regular', deferred=None):
+    """Return the cleaned tag rows of element, skipping empty values and
+    keys with problem chars"""
+    element_id = attribs['id']
+    return [{"id": element_id, "key": key, "value": value, "type": tag_type}
+            for key, value, tag_type in iter_clean_tags(element, attribs,
+                                                        default_tag_type, deferred)]
 
-                tags.append(data)  
 
-        #print "tags:"
-        #pprint.pprint(tags)        
+###
+# PURPOSE: clean and shape node, way or relation XML element to Python dict
+###
+def shape_element(element, node_attr_fields=NODE_FIELDS, \
+                  way_attr_fields=WAY_FIELDS,\
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular',
+                  relation_attr_fields=RELATION_FIELDS, deferred=None):
+    """Clean and shape node, way or relation XML element to Python dict"""
 
+    attrib = element.attrib
+    if element.tag == 'node':
+        node_attribs = dict((f, attrib[f]) for f in node_attr_fields)
+        tags = shape_tags(element, node_attribs, default_tag_type, deferred)
         return {'node': node_attribs, 'node_tags': tags}
     elif element.tag == 'way':
-        way_attribs['id'] = element.attrib['id']
-        way_attribs['user'] = element.attrib['user']
-        way_attribs['uid'] = element.attrib['uid']
-        way_attribs['version'] = element.attrib['version']
-        way_attribs['changeset'] = element.attrib['changeset']
-        way_attribs['timestamp'] = element.attrib['timestamp']
-        #print "way_attribs:"
-        #pprint.pprint(way_attribs)
-
+        way_attribs = dict((f, attrib[f]) for f in way_attr_fields)
+        way_id = way_attribs['id']
+        way_nodes = []
+        count = 0
         for sub in element:
             if sub.tag == 'nd':
-                dt = {
-                    "id": None,
-                    "node_id": None,
-                    "position": []
-                }                
-                dt["id"] = way_attribs['id']
-                dt["node_id"] = sub.attrib['ref']
-                dt["position"] = count
-                count +=1
-                way_nodes.append(dt) 
-            
-            if sub.tag == 'tag':
-                data = {
-                    "id": None,
-                    "key": None,
-                    "value": None,
-                    "type": None
-                }                
-                data["id"] = way_attribs['id']
-                data["value"] = sub.attrib['v']
-                str = sub.attrib['k']
-                ret = is_empty(sub)
-                if ret == 1:
-                    #print "Correct leading or trailing space in value for element:"
-                    data["value"] = data["value"].strip()                    
-                elif ret == 2:
-                    # empty tag to be skipped
-                    continue                                    
-                if is_street_name(sub):
-                    #name = data["value"].upper()
-                    name = data["value"]
-                    better_name = update_name(name,mapping)
-                    data["value"] = better_name
-                elif is_house_number(sub):
-                    nb = data["value"]
-                    lst = filter(None, re.split("[,;\-]+", nb))
-                    s = []
-                    for item in lst:
-                        s.append(update_housenb(item, bis_ter_quater))
-                    better_nb = ';'.join(s)
-                    data["value"] = better_nb
-                elif is_phone(sub):
-                    phone = data["value"]
-                    lst = phone.split(';')
-                    s = []
-                    for item in lst:
-                        s.append(update_phone(item))
-                    ph = ';'.join(s)
-                    data["value"] = ph
-                        
-                        
-                if re.search(PROBLEMCHARS, str) != None:
-                    print "PROBLEMS node_attribs:"
-                    pprint.pprint(way_attribs)                    
-                    continue
-                elif re.search(LOWER_COLON, str) != None:
-                    data["type"] = str.split(":")[0]
-                    data["key"] = ":".join(str.split(":")[1:])
-                else:
-                    data["type"] = "regular"
-                    data["key"] = str
+                way_nodes.append({"id": way_id,
+                                  "node_id": sub.attrib['ref'],
+                                  "position": count})
+                count += 1
+        tags = shape_tags(element, way_attribs, default_tag_type, deferred)
+        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+    elif element.tag == 'relation':
+        relation_attribs = dict((f, attrib[f]) for f in relation_attr_fields)
+        relation_id = relation_attribs['id']
+        members = []
+        count = 0
+        for sub in element:
+            if sub.tag == 'member':
+                members.append({"id": relation_id,
+                                "type": sub.attrib['type'],
+                                "ref": sub.attrib['ref'],
+                                "role": sub.attrib.get('role', ''),
+                                "position": count})
+                count += 1
+        tags = shape_tags(element, relation_attribs, default_tag_type, deferred)
+        return {'relation': relation_attribs, 'relation_members': members,
+                'relation_tags': tags}
+
+# fields of the rows of each part of a shaped element
+ROW_FIELDS = {
+    'node': NODE_FIELDS, 'node_tags': NODE_TAGS_FIELDS,
+    'way': WAY_FIELDS, 'way_nodes': WAY_NODES_FIELDS, 'way_tags': WAY_TAGS_FIELDS,
+    'relation': RELATION_FIELDS, 'relation_members': RELATION_MEMBERS_FIELDS,
+    'relation_tags': RELATION_TAGS_FIELDS,
+}
 
-                tags.append(data)  
 
+def _utf8(value):
+    return value.encode('utf-8') if value.__class__ is unicode else value
+
+
+###
+# PURPOSE: fast path of shape_element, tuple rows ready for csv.writer
+###
+def shape_element_rows(element, interner=None, deferred=None):
+    """Like shape_element, but every row is a tuple in the order of its
+    *_FIELDS list, with the strings already utf-8 encoded
+
+    No dict is built per element, tag or nd ref, and the rows go straight
+    to csv.writer (see CsvExporter(rows='tuple')). With an interner (a
+    TagInterner) the tag rows are (id, key_id, value_id). deferred is
+    passed to iter_clean_tags.
+    """
+    attrib = element.attrib
+    tag = element.tag
+    if tag == 'node':
+        fields = NODE_FIELDS
+    elif tag == 'way':
+        fields = WAY_FIELDS
+    elif tag == 'relation':
+        fields = RELATION_FIELDS
+    else:
+        return None
+    row = tuple([_utf8(attrib[f]) for f in fields])
+    element_id = row[0]
+    if interner is not None:
+        tags = interner.tag_rows(element_id,
+                                 iter_clean_tags(element, attrib, deferred=deferred))
+    else:
+        tags = [(element_id, _utf8(key), _utf8(value), _utf8(tag_type))
+                for key, value, tag_type in iter_clean_tags(element, attrib,
+                                                            deferred=deferred)]
+    if tag == 'node':
+        return {'node': row, 'node_tags': tags}
+    if tag == 'way':
+        refs = [sub.attrib['ref'] for sub in element if sub.tag == 'nd']
+        return {'way': row,
+                'way_nodes': [(element_id, ref, position)
+                              for position, ref in enumerate(refs)],
+                'way_tags': tags}
+    members = [sub.attrib for sub in element if sub.tag == 'member']
+    return {'relation': row,
+            'relation_members': [(element_id, m['type'], m['ref'],
+                                  _utf8(m.get('role', '')), position)
+                                 for position, m in enumerate(members)],
+            'relation_tags': tags}
+
+
+def rows_to_dicts(el):
+    """shape_element form of a shape_element_rows element (for validation)"""
+    shaped = {}
+    for part, value in el.iteritems():
+        fields = ROW_FIELDS[part]
+        if isinstance(value, tuple):
+            shaped[part] = dict(zip(fields, value))
+        else:
+            shaped[part] = [dict(zip(fields, row)) for row in value]
+    return shaped
 
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
+class ElementStream(object):
+    """Iterate over the complete top level elements of an osm file
+
+    Shared bounded-memory stream used by get_element, audit_map and the
+    audit functions:
+      - elements are handed out on their 'end' event, so all their tag/nd/
+        member children are parsed;
+      - once the consumer asks for the next element the previous one is
+        cleared, together with every sibling still attached to the root.
+
+    Peak memory is therefore the parser read buffer (64 KB) plus the
+    largest single top level element (a few hundred KB for a big relation),
+    independent of the file size: it stays at a few MB above the
+    interpreter baseline from the 13 MB Nanterre sample to a multi-GB
+    country extract. An element must not be kept once the next one has
+    been requested; copy what is needed (e.g. dict(elem.attrib)) instead.
+    """
+
+    def __init__(self, osm_file, tags=None):
+        self.source = None
+        self.tags = tags
+        # .osm.pbf: elements decoded by pbf.PbfReader, no xml to parse
+        if pbf.is_pbf(osm_file):
+            osm_file = pbf.PbfReader(osm_file)
+        if isinstance(osm_file, pbf.PbfReader):
+            self.source = osm_file
+            self.context = None
+            self.root = ET.Element('osm')
+            return
+        # .osm.gz, .osm.bz2 and .zip are decompressed on the fly
+        if isinstance(osm_file, basestring) and osmio.is_compressed(osm_file):
+            osm_file = self.source = osmio.open_osm(osm_file)
+        self.context = ET.iterparse(osm_file, events=('start', 'end'))
+        _, self.root = next(self.context)
+
+    def __iter__(self):
+        root = self.root
+        tags = self.tags
+        depth = 0
+        try:
+            if self.context is None:
+                for elem in self.source:
+                    if tags is None or elem.tag in tags:
+                        yield elem
+                return
+            for event, elem in self.context:
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 0:
+                    if tags is None or elem.tag in tags:
+                        yield elem
+                    elem.clear()
+                    root.clear()
+        finally:
+            if self.source is not None:
+                self.source.close()
+
+
 def get_element(osm_file, tags=('node', 'way', 'relation')):
     """Yield element if it is the right type of tag"""
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    return iter(ElementStream(osm_file, tags))
 
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
@@ -557,6 +948,254 @@ def validate_element(element, validator, schema=SCHEMA):
 
 
 
+###
+# OBJECTIVE: validate shaped elements against SCHEMA without cerberus
+###
+_MISSING = object()
+
+SCHEMA_TYPES = {
+    'integer': (int, long),
+    'float': (float, int, long),
+    'number': (float, int, long),
+    'string': basestring,
+    'boolean': bool,
+}
+
+# Whole column checks: the values of a numeric field over a batch of rows
+# are joined with ',' and matched at once. A ',' inside a value changes
+# the separator count and sends the batch to the per row check.
+COLUMN_PATTERNS = {
+    int: re.compile(r'-?\d+(?:,-?\d+)*\Z'),
+    float: re.compile(r'-?\d+(?:\.\d*)?(?:,-?\d+(?:\.\d*)?)*\Z'),
+}
+
+def compile_schema(schema=SCHEMA):
+    """Compile the cerberus schema once into per table field checks
+
+    Returns {table: (kind, fields, columns)} where kind is 'dict' (one
+    row) or 'list' (rows), fields is a tuple of
+    (name, required, nullable, coerce, types, regex, allowed) used by the
+    per row check, and columns the (name, pattern) whole column checks
+    of the batch path, or None when a rule needs the per row check.
+    Only the rules used by the csv schema are supported.
+    """
+    supported = set(['type', 'required', 'nullable', 'coerce', 'regex', 'allowed'])
+    compiled = {}
+    for table, rules in schema.iteritems():
+        kind = rules['type']
+        row_rules = rules['schema']
+        if kind == 'list':
+            row_rules = row_rules['schema']
+        fields = []
+        columns = []
+        for name, field in sorted(row_rules.iteritems()):
+            unknown = set(field) - supported
+            if unknown:
+                raise ValueError("unsupported schema rule(s) %s for %s.%s"
+                                 % (sorted(unknown), table, name))
+            regex = field.get('regex')
+            if regex is not None:
+                regex = re.compile(r'(?:%s)\Z' % regex)
+            allowed = field.get('allowed')
+            types = SCHEMA_TYPES.get(field.get('type'))
+            coerce = field.get('coerce')
+            fields.append((name, field.get('required', False),
+                           field.get('nullable', False), coerce, types, regex,
+                           frozenset(allowed) if allowed is not None else None))
+
+            if columns is None:
+                continue
+            if regex is not None or allowed is not None:
+                columns = None
+            elif coerce is None and types is basestring:
+                columns.append((name, None))
+            elif coerce in COLUMN_PATTERNS:
+                columns.append((name, COLUMN_PATTERNS[coerce]))
+            else:
+                columns = None
+        compiled[table] = (kind, tuple(fields), columns)
+    return compiled
+
+
+class FastValidator(object):
+    """Check shaped elements against a compiled SCHEMA and report errors
+
+    Unlike validate_element it does not raise: every error is counted per
+    table.field and the first max_examples are kept for report(). With
+    every=N only one element out of N is checked. Elements are checked in
+    batches of batch_size: each column of the batch is checked at once
+    (string type, int/float coercion) and only the tables of a failing
+    batch are checked again row by row to find the errors.
+    """
+
+    def __init__(self, schema=SCHEMA, every=1, batch_size=1000, max_examples=100):
+        self.schema = schema
+        self.tables = compile_schema(schema)
+        self.every = every
+        self.batch_size = batch_size
+        self.max_examples = max_examples
+        self.pending = []
+        self.seen = 0
+        self.checked = 0
+        self.errors = 0
+        self.by_field = defaultdict(int)
+        self.examples = []
+
+    def __getstate__(self):
+        # sent to and back from the parallel export workers
+        state = self.__dict__.copy()
+        del state['tables']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tables = compile_schema(self.schema)
+
+    def validate(self, el):
+        """Return the list of (field, message) errors of one shaped element"""
+        errors = []
+        for table, value in el.iteritems():
+            compiled = self.tables.get(table)
+            if compiled is None:
+                errors.append((table, 'unknown field'))
+                continue
+            kind, fields, _ = compiled
+            if kind == 'dict':
+                self._check_row(table, fields, value, errors)
+            else:
+                for row in value:
+                    self._check_row(table, fields, row, errors)
+        return errors
+
+    @staticmethod
+    def _check_row(table, fields, row, errors):
+        for name, required, nullable, coerce, types, regex, allowed in fields:
+            value = row.get(name, _MISSING)
+            if value is _MISSING:
+                if required:
+                    errors.append((table + '.' + name, 'required field'))
+                continue
+            if value is None:
+                if not nullable:
+                    errors.append((table + '.' + name, 'null value not allowed'))
+                continue
+            if coerce is not None:
+                try:
+                    value = coerce(value)
+                except (ValueError, TypeError):
+                    errors.append((table + '.' + name,
+                                   'cannot coerce %r' % (value,)))
+                    continue
+            if types is not None and not isinstance(value, types):
+                errors.append((table + '.' + name, 'wrong type %r' % (value,)))
+            elif regex is not None and not regex.match(value):
+                errors.append((table + '.' + name,
+                               'value does not match regex %r' % (value,)))
+            elif allowed is not None and value not in allowed:
+                errors.append((table + '.' + name, 'unallowed value %r' % (value,)))
+        if len(row) > len(fields):
+            known = set(f[0] for f in fields)
+            for name in row:
+                if name not in known:
+                    errors.append((table + '.' + name, 'unknown field'))
+
+    @staticmethod
+    def _check_columns(fields, columns, rows):
+        """True when every row of the batch is valid, None if unsure"""
+        if not rows:
+            return True
+        if columns is None or len(set(map(len, rows))) != 1 \
+                or len(rows[0]) != len(fields):
+            return None
+        separators = len(rows) - 1
+        try:
+            for name, pattern in columns:
+                column = map(operator.itemgetter(name), rows)
+                if pattern is None:
+                    # join raises TypeError unless every value is a string
+                    ','.join(column)
+                    continue
+                try:
+                    column = ','.join(column)
+                except TypeError:
+                    # numbers may already be int (e.g. way_nodes.position)
+                    column = ','.join(map(str, column))
+                if column.count(',') != separators or not pattern.match(column):
+                    return None
+        except (KeyError, TypeError, UnicodeError):
+            return None
+        return True
+
+    def check(self, el):
+        """Queue el (or every Nth element) for validation"""
+        self.seen += 1
+        if self.every > 1 and self.seen % self.every:
+            return
+        self.pending.append(el)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def check_batch(self, els):
+        """Validate a batch of shaped elements and record their errors"""
+        self.checked += len(els)
+        rows = defaultdict(list)
+        for el in els:
+            for table, value in el.iteritems():
+                if isinstance(value, dict):
+                    rows[table].append(value)
+                else:
+                    rows[table].extend(value)
+
+        suspect = set()
+        for table, table_rows in rows.iteritems():
+            compiled = self.tables.get(table)
+            if compiled is None:
+                suspect.add(table)
+                continue
+            kind, fields, columns = compiled
+            if not self._check_columns(fields, columns, table_rows):
+                suspect.add(table)
+
+        if suspect:
+            for el in els:
+                if suspect.intersection(el):
+                    errors = self.validate(el)
+                    if errors:
+                        self._record(el, errors)
+
+    def flush(self):
+        """Validate the queued elements"""
+        if self.pending:
+            pending, self.pending = self.pending, []
+            self.check_batch(pending)
+
+    def _record(self, el, errors):
+        self.errors += len(errors)
+        for field, message in errors:
+            self.by_field[field] += 1
+        if len(self.examples) < self.max_examples:
+            row = el.get('node') or el.get('way') or el.get('relation') or {}
+            self.examples.append({'id': row.get('id'), 'errors': errors})
+
+    def merge(self, other):
+        """Add the counts and examples of another FastValidator"""
+        self.flush()
+        other.flush()
+        self.seen += other.seen
+        self.checked += other.checked
+        self.errors += other.errors
+        for field, count in other.by_field.iteritems():
+            self.by_field[field] += count
+        room = self.max_examples - len(self.examples)
+        self.examples.extend(other.examples[:max(room, 0)])
+
+    def report(self):
+        self.flush()
+        return {'seen': self.seen, 'checked': self.checked,
+                'errors': self.errors, 'by_field': dict(self.by_field),
+                'examples': self.examples}
+
+
 ###
 # OBJECTIVE: Extend csv.DictWriter to handle Unicode input
 ### 
@@ -572,77 +1211,2542 @@ class UnicodeDictWriter(csv.DictWriter, object):
         for row in rows:
             self.writerow(row)
 
+###
+# OBJECTIVE: base class of the process_map output backends
+###
+class ElementExporter(object):
+    """Abstract base: shape and validate elements and hand the rows to a backend
+
+    validate is False, True (cerberus validate_element, raising on the
+    first error) or a FastValidator collecting errors into its report.
+    Subclasses are context managers for one storage (csv files, sqlite
+    database...) and must override write_node(), write_way() and
+    write_relation(): they cannot be instantiated otherwise.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, validate=False):
+        self.validate = validate
+        self.validator = cerberus.Validator()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def shape(self, element):
+        return shape_element(element)
+
+    def write(self, element):
+        """Shape, optionally validate, and write one node, way or relation"""
+        el = self.shape(element)
+        if el:
+            self.check(el)
+            self.write_shaped(element.tag, el)
+
+    def check(self, el):
+        """Validate a shaped element as asked by validate"""
+        if self.validate is True:
+            validate_element(el, self.validator)
+        elif self.validate:
+            self.validate.check(el)
+
+    def write_shaped(self, tag, el):
+        if tag == 'node':
+            self.write_node(el)
+        elif tag == 'way':
+            self.write_way(el)
+        elif tag == 'relation':
+            self.write_relation(el)
+
+    @abc.abstractmethod
+    def write_node(self, el):
+        """Write the rows of a shaped node"""
+
+    @abc.abstractmethod
+    def write_way(self, el):
+        """Write the rows of a shaped way"""
+
+    @abc.abstractmethod
+    def write_relation(self, el):
+        """Write the rows of a shaped relation"""
+
+
+###
+# OBJECTIVE: Shape elements and write them to the csv(s)
+###
+class CsvExporter(ElementExporter):
+    """Shape elements and write them to the csv(s) of CSV_PATHS
+
+    rows='dict' shapes with shape_element and writes with
+    UnicodeDictWriter; rows='tuple' is the fast path, shaping with
+    shape_element_rows and writing with plain csv.writer. Both write the
+    same csv(s).
+    """
+
+    # fields of each file of paths
+    fields = CSV_FIELDS
+
+    def __init__(self, validate=False, paths=CSV_PATHS, header=True, compress=False,
+                 rows='dict', append=False):
+        super(CsvExporter, self).__init__(validate)
+        if compress:
+            # gzip csv(s): nodes.csv.gz...
+            paths = tuple(path + osmio.GZ_SUFFIX for path in paths)
+        if rows not in ('dict', 'tuple'):
+            raise ValueError("rows is 'dict' or 'tuple', not %r" % (rows,))
+        self.paths = paths
+        self.header = header
+        self.compress = compress
+        self.rows = rows
+        self.append = append
+
+    def __enter__(self):
+        # TIP: use of wb instead of w for avoiding blank line.
+        # ISSUE with utf-8 encoding -> ANSI
+        self.files = [osmio.open_output(path, self.compress, self.append)
+                      for path in self.paths]
+        nodes_file, nodes_tags_file, ways_file, way_nodes_file, way_tags_file, \
+            relations_file, relation_members_file, relation_tags_file = self.files
+        nodes_fields, nodes_tags_fields, ways_fields, way_nodes_fields, \
+            way_tags_fields, relations_fields, relation_members_fields, \
+            relation_tags_fields = self.fields
+
+        self.nodes_writer = UnicodeDictWriter(nodes_file, nodes_fields)
+        self.node_tags_writer = UnicodeDictWriter(nodes_tags_file, nodes_tags_fields)
+        self.ways_writer = UnicodeDictWriter(ways_file, ways_fields)
+        self.way_nodes_writer = UnicodeDictWriter(way_nodes_file, way_nodes_fields)
+        self.way_tags_writer = UnicodeDictWriter(way_tags_file, way_tags_fields)
+        self.relations_writer = UnicodeDictWriter(relations_file, relations_fields)
+        self.relation_members_writer = UnicodeDictWriter(relation_members_file,
+                                                         relation_members_fields)
+        self.relation_tags_writer = UnicodeDictWriter(relation_tags_file,
+                                                      relation_tags_fields)
+
+        if self.header:
+            self.nodes_writer.writeheader()
+            self.node_tags_writer.writeheader()
+            self.ways_writer.writeheader()
+            self.way_nodes_writer.writeheader()
+            self.way_tags_writer.writeheader()
+            self.relations_writer.writeheader()
+            self.relation_members_writer.writeheader()
+            self.relation_tags_writer.writeheader()
+
+        if self.rows == 'tuple':
+            # same files and dialect, rows written as they are
+            for name, writer in vars(self).items():
+                if isinstance(writer, UnicodeDictWriter):
+                    setattr(self, name, writer.writer)
+
+        return self
+
+    def shape(self, element):
+        if self.rows == 'tuple':
+            return shape_element_rows(element)
+        return shape_element(element)
+
+    def check(self, el):
+        if self.rows == 'tuple' and self.validate:
+            el = rows_to_dicts(el)
+        super(CsvExporter, self).check(el)
+
+    def __exit__(self, *exc_info):
+        for f in self.files:
+            f.close()
+        return False
+
+    def write_node(self, el):
+        self.nodes_writer.writerow(el['node'])
+        self.node_tags_writer.writerows(el['node_tags'])
+
+    def write_way(self, el):
+        self.ways_writer.writerow(el['way'])
+        self.way_nodes_writer.writerows(el['way_nodes'])
+        self.way_tags_writer.writerows(el['way_tags'])
+
+    def write_relation(self, el):
+        self.relations_writer.writerow(el['relation'])
+        self.relation_members_writer.writerows(el['relation_members'])
+        self.relation_tags_writer.writerows(el['relation_tags'])
+
+PIPELINE_BATCH_SIZE = 2000
+PIPELINE_QUEUE_SIZE = 8
+
+###
+# OBJECTIVE: csv export with one writer thread per csv file
+###
+class PipelinedCsvExporter(CsvExporter):
+    """CsvExporter whose csv(s) are written by one thread per file
+
+    The caller parses and shapes; rows are handed in batches of
+    batch_size to the writer thread of their file through a queue of at
+    most queue_size batches, which blocks the caller when a writer falls
+    behind (memory stays bounded). Every file has a single writer that
+    receives its rows in order, so the csv(s) are the same as with
+    CsvExporter. The overlap is between parsing and shaping on one side
+    and the write syscalls (and gzip compression, see compress) on the
+    other, which run without the GIL.
+
+    write() also shapes in batches of batch_size elements: the values of
+    the cleaners of BATCH_CLEANERS are left raw while an element is
+    shaped, and the column of them collected from the whole batch is
+    normalized in one go (normalize_phones...) before the batch is
+    validated and written. Same rows as the cleaners one value at a
+    time; batch_clean=False turns it off.
+    """
+
+    WRITERS = ('nodes_writer', 'node_tags_writer', 'ways_writer',
+               'way_nodes_writer', 'way_tags_writer', 'relations_writer',
+               'relation_members_writer', 'relation_tags_writer')
+
+    def __init__(self, validate=False, paths=CSV_PATHS, header=True, compress=False,
+                 rows='dict', batch_size=PIPELINE_BATCH_SIZE,
+                 queue_size=PIPELINE_QUEUE_SIZE, batch_clean=True):
+        super(PipelinedCsvExporter, self).__init__(validate, paths, header, compress,
+                                                   rows)
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.batch_clean = batch_clean
+
+    def __enter__(self):
+        super(PipelinedCsvExporter, self).__enter__()
+        self.errors = []
+        self.buffers = dict((name, []) for name in self.WRITERS)
+        self.queues = dict((name, Queue.Queue(self.queue_size)) for name in self.WRITERS)
+        self.threads = [threading.Thread(target=self._write_batches, args=(name,))
+                        for name in self.WRITERS]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        self.pending = []
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if exc_info[0] is None:
+                self._write_pending()
+            for name in self.WRITERS:
+                if exc_info[0] is None:
+                    self._send(name)
+                self.queues[name].put(None)
+            for thread in self.threads:
+                thread.join()
+        finally:
+            super(PipelinedCsvExporter, self).__exit__(*exc_info)
+        if self.errors and exc_info[0] is None:
+            raise self.errors[0]
+        return False
+
+    def _write_batches(self, name):
+        queue = self.queues[name]
+        while True:
+            batch = queue.get()
+            if batch is None:
+                return
+            if self.errors:
+                continue    # drain the queue, the error is raised by the caller
+            try:
+                # looked up per batch: ExportMetrics may wrap the writer
+                getattr(self, name).writerows(batch)
+            except Exception as e:
+                self.errors.append(e)
+
+    def _send(self, name):
+        batch = self.buffers[name]
+        if batch:
+            if self.errors:
+                raise self.errors[0]
+            self.queues[name].put(batch)
+            self.buffers[name] = []
+
+    def write(self, element):
+        """Shape element, the values of BATCH_CLEANERS being cleaned with
+        the rest of the batch"""
+        if not self.batch_clean:
+            return super(PipelinedCsvExporter, self).write(element)
+        # (position, k, cleaner) of the tags left raw by iter_clean_tags
+        deferred = []
+        if self.rows == 'tuple':
+            el = shape_element_rows(element, deferred=deferred)
+        else:
+            el = shape_element(element, deferred=deferred)
+        if el:
+            self.pending.append((element.tag, el, deferred))
+            if len(self.pending) >= self.batch_size:
+                self._write_pending()
+
+    def _write_pending(self):
+        pending, self.pending = self.pending, []
+        # batch cleaner -> [(tag rows, index of the row), ...] of the
+        # rows deferred by iter_clean_tags, and only those
+        columns = defaultdict(list)
+        for tag, el, deferred in pending:
+            tags = el[tag + '_tags']
+            for index, k, cleaner in deferred:
+                columns[BATCH_CLEANERS[cleaner]].append((tags, index))
+        for normalize, cells in columns.iteritems():
+            raw = [tags[index][2] if tags[index].__class__ is tuple
+                   else tags[index]['value'] for tags, index in cells]
+            for (tags, index), value, cleaned in zip(cells, raw, normalize(raw)):
+                if cleaned != value:
+                    TAG_COUNTERS['cleaned'] += 1
+                    row = tags[index]
+                    if row.__class__ is tuple:
+                        tags[index] = row[:2] + (cleaned,) + row[3:]
+                    else:
+                        row['value'] = cleaned
+        for tag, el, deferred in pending:
+            self.check(el)
+            self.write_shaped(tag, el)
+
+    def _add(self, name, rows):
+        buffered = self.buffers[name]
+        buffered.extend(rows)
+        if len(buffered) >= self.batch_size:
+            self._send(name)
+
+    def write_node(self, el):
+        self._add('nodes_writer', (el['node'],))
+        self._add('node_tags_writer', el['node_tags'])
+
+    def write_way(self, el):
+        self._add('ways_writer', (el['way'],))
+        self._add('way_nodes_writer', el['way_nodes'])
+        self._add('way_tags_writer', el['way_tags'])
+
+    def write_relation(self, el):
+        self._add('relations_writer', (el['relation'],))
+        self._add('relation_members_writer', el['relation_members'])
+        self._add('relation_tags_writer', el['relation_tags'])
+
 ###
 # OBJECTIVE: Iteratively process each XML element and write to csv(s)
 ###             
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    # TIP: use of wb instead of w for avoiding blank line.
-    # ISSUE with utf-8 encoding -> ANSI
-    with codecs.open(NODES_PATH, mode='wb') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, mode='wb') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, mode='wb') as ways_file, \
-         codecs.open(WAY_NODES_PATH, mode='wb') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, mode='wb') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
+def process_map(file_in, validate, processes=1, db_path=None, metrics=None,
+                compress=False, columns_dir=None, geometry=False, node_index=None,
+                spatial=False, pipelined=False, rows='dict', checkpoint=None,
+                interned=False, summary=None):
+    """Iteratively process each XML element and write to csv(s)
+
+    validate: False, True (cerberus, raises on the first invalid element)
+    or a FastValidator whose report() lists the errors after the run.
+    With processes > 1 the export is sharded over a process pool
+    (see process_map_parallel); the csv(s) are identical.
+    With db_path the rows are loaded straight into that sqlite database
+    (see SqliteExporter) instead of the csv(s), with an R*Tree spatial
+    index if spatial=True (see SpatialIndex), and with columns_dir
+    they are written there as typed Parquet or .npy columns (see
+    ColumnarExporter).
+    With geometry=True the bbox, centroid, length and area of every way
+    are written to ways_geometry.csv as well (see GeometryExporter); the
+    node coordinates are kept in memory, or memory mapped in the
+    node_index file if given.
+    With metrics (an ExportMetrics) the run is timed per stage and its
+    progress logged; without it nothing is measured.
+    file_in may be a .osm, .osm.gz, .osm.bz2, .zip or .osm.pbf file; with
+    compress=True the csv(s) are written gzip compressed (nodes.csv.gz...).
+    With pipelined=True the csv(s) are written by one thread per file
+    while the file is parsed (see PipelinedCsvExporter); same csv(s).
+    rows='tuple' is the fast path of the csv export, with tuple rows and
+    csv.writer instead of dicts and DictWriter (see CsvExporter).
+    Options that do not apply together (pipelined or rows with db_path or
+    columns_dir, pipelined with processes > 1...) raise ValueError.
+    With checkpoint (a path) a checkpoint is saved there regularly and an
+    interrupted run resumes from it (see process_map_resumable).
+    With interned=True the tag csv(s) hold key and value ids into
+    tag_keys.csv and tag_values.csv (see InternedCsvExporter).
+    With summary (a path) the element, user, tag and numeric value
+    statistics are written there as JSON (see SummaryExporter).
+    """
+    if spatial and db_path is None:
+        raise ValueError("the spatial index is built in the sqlite export")
+    if interned and (processes > 1 or db_path is not None or columns_dir is not None or
+                     pipelined or checkpoint is not None):
+        raise ValueError("tags are only interned by the plain csv export")
+    if pipelined and (processes > 1 or db_path is not None or columns_dir is not None):
+        raise ValueError("the pipelined export is the single process csv export")
+    if rows != 'dict' and (db_path is not None or columns_dir is not None):
+        raise ValueError("rows only applies to the csv export")
+    if checkpoint is not None:
+        if (processes > 1 or db_path is not None or columns_dir is not None or
+                metrics is not None or compress or geometry or pipelined or
+                summary is not None):
+            raise ValueError("checkpoints are only saved by the plain csv export")
+        return process_map_resumable(file_in, validate, checkpoint, rows=rows)
+    if db_path is not None:
+        if processes > 1:
+            raise ValueError("the sqlite export runs in a single process")
+        exporter = SqliteExporter(db_path, validate, spatial=spatial)
+    elif columns_dir is not None:
+        if processes > 1:
+            raise ValueError("the columnar export runs in a single process")
+        exporter = ColumnarExporter(columns_dir, validate=validate)
+    elif processes > 1:
+        if metrics is not None:
+            raise ValueError("metrics are only collected in a single process")
+        if geometry:
+            raise ValueError("the way geometry needs all the nodes in one process")
+        if summary is not None:
+            raise ValueError("the summary is computed in a single process")
+        return process_map_parallel(file_in, validate, processes, compress=compress,
+                                    rows=rows)
+    elif pipelined:
+        exporter = PipelinedCsvExporter(validate, compress=compress, rows=rows)
+    elif interned:
+        exporter = InternedCsvExporter(validate, compress=compress)
+    else:
+        exporter = CsvExporter(validate, compress=compress, rows=rows)
+    if geometry:
+        exporter = GeometryExporter(exporter, index_path=node_index)
+    if summary is not None:
+        exporter = SummaryExporter(exporter, summary)
+
+    with exporter:
+        if metrics is not None:
+            return metrics.run(file_in, exporter)
+        for element in get_element(file_in, tags=EXPORT_TAGS):
+            exporter.write(element)
+
+# ================================================== #
+#               Instrumentation                      #
+# ================================================== #
+
+###
+# OBJECTIVE: csv writer proxy adding its time to a timer
+###
+class _TimedWriter(object):
+
+    def __init__(self, writer, timers, name):
+        self.writer = writer
+        self.timers = timers
+        self.name = name
+
+    def writerow(self, row):
+        start = time.time()
+        self.writer.writerow(row)
+        self.timers[self.name] += time.time() - start
+
+    def writerows(self, rows):
+        start = time.time()
+        self.writer.writerows(rows)
+        self.timers[self.name] += time.time() - start
+
+
+###
+# OBJECTIVE: opt-in per stage timing and progress log of process_map
+###
+class ExportMetrics(object):
+    """Time and log a process_map run
+
+    Measures elements processed, bytes of input consumed, the time spent
+    in get_element (parse), shape_element (shape, without the cleaners),
+    each cleaner, the validation and each csv writer, plus the tags
+    stripped, cleaned or dropped (empty value, PROBLEMCHARS) and the hit
+    rates of the normalizer caches.
+
+    Every interval seconds a progress line goes to stream (stderr by
+    default) and, with jsonl_path, a JSON snapshot is appended to that
+    file. process_map only takes this path when metrics are passed, so a
+    run without them pays nothing.
+    """
+
+    def __init__(self, interval=10.0, stream=sys.stderr, jsonl_path=None):
+        self.interval = interval
+        self.stream = stream
+        self.jsonl_path = jsonl_path
+        self.timers = defaultdict(float)
+        self.elements = 0
+        self.bytes = 0
+        self.started = None
+        self.osm_file = None
+
+    def _timed_cleaner(self, key, cleaner):
+        timers = self.timers
+        name = 'clean:' + key
+
+        def clean(value):
+            start = time.time()
+            result = cleaner(value)
+            timers[name] += time.time() - start
+            return result
+        return clean
+
+    def run(self, file_in, exporter):
+        """Export file_in with exporter, measuring every stage"""
+        timers = self.timers
+        # GeometryExporter and SummaryExporter wrap the exporter writing the csv(s)
+        target = exporter
+        while target is not None:
+            for name, writer in vars(target).items():
+                if name.endswith('_writer') and hasattr(writer, 'writerows'):
+                    setattr(target, name,
+                            _TimedWriter(writer, timers, 'write:' + name[:-len('_writer')]))
+            target = getattr(target, 'exporter', None)
+        cleaners = dict(TAG_CLEANERS)
+        for key, cleaner in cleaners.items():
+            TAG_CLEANERS[key] = self._timed_cleaner(key, cleaner)
+        self.tags_start = dict(TAG_COUNTERS)
+
+        self.started = time.time()
+        next_log = self.started + self.interval
+        try:
+            source = (pbf.PbfReader(file_in) if pbf.is_pbf(file_in)
+                      else osmio.open_osm(file_in))
+            with source as osm_file:
+                self.osm_file = osm_file
+                elements = get_element(osm_file, tags=EXPORT_TAGS)
+                while True:
+                    t0 = time.time()
+                    element = next(elements, None)
+                    t1 = time.time()
+                    if element is None:
+                        break
+                    el = exporter.shape(element)
+                    t2 = time.time()
+                    exporter.check(el)
+                    t3 = time.time()
+                    exporter.write_shaped(element.tag, el)
+                    t4 = time.time()
+                    timers['parse'] += t1 - t0
+                    timers['shape'] += t2 - t1
+                    timers['validate'] += t3 - t2
+                    timers['write'] += t4 - t3
+                    self.elements += 1
+                    if t4 >= next_log:
+                        self.log()
+                        next_log = t4 + self.interval
+                self.bytes = osmio.position(osm_file)
+        finally:
+            self.osm_file = None
+            TAG_CLEANERS.update(cleaners)
+        self.log(final=True)
+        return self.snapshot()
+
+    def snapshot(self):
+        """Current metrics as a JSON serialisable dict"""
+        elapsed = time.time() - self.started
+        if self.osm_file is not None:
+            self.bytes = osmio.position(self.osm_file)
+        stages = dict(self.timers)
+        cleaning = sum(v for k, v in stages.iteritems() if k.startswith('clean:'))
+        # shape_element calls the cleaners
+        stages['shape'] = stages.get('shape', 0.0) - cleaning
+        tags = dict((k, v - self.tags_start.get(k, 0))
+                    for k, v in TAG_COUNTERS.iteritems())
+        return {
+            'elements': self.elements,
+            'bytes': self.bytes,
+            'elapsed': elapsed,
+            'elements_per_sec': self.elements / elapsed if elapsed else 0.0,
+            'mb_per_sec': self.bytes / 1e6 / elapsed if elapsed else 0.0,
+            'stages': stages,
+            'tags': tags,
+            'caches': cache_stats(),
+        }
+
+    def log(self, final=False):
+        metrics = self.snapshot()
+        if self.stream is not None:
+            stages = metrics['stages']
+            total = sum(stages.get(k, 0.0) for k in ('parse', 'shape', 'validate', 'write')) \
+                + sum(v for k, v in stages.iteritems() if k.startswith('clean:'))
+            split = ' '.join('%s %.0f%%' % (k, 100.0 * stages.get(k, 0.0) / total)
+                             for k in ('parse', 'shape', 'validate', 'write')) if total else ''
+            self.stream.write("%s%d elements, %.1f MB, %.0f elements/s, %.1f MB/s | %s\n" % (
+                "END " if final else "", metrics['elements'], metrics['bytes'] / 1e6,
+                metrics['elements_per_sec'], metrics['mb_per_sec'], split))
+        if self.jsonl_path is not None:
+            metrics['final'] = final
+            with open(self.jsonl_path, 'a') as out:
+                out.write(json.dumps(metrics, sort_keys=True) + '\n')
+
+# ================================================== #
+#               SQLite Export                        #
+# ================================================== #
+
+# Same tables as the csv(s) imported with sqlite> .import
+SQL_TABLES = [
+    ('nodes', NODE_FIELDS, """CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat REAL,
+    lon REAL,
+    user TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+)"""),
+    ('nodes_tags', NODE_TAGS_FIELDS, """CREATE TABLE nodes_tags (
+    id INTEGER,
+    key TEXT,
+    value TEXT,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES nodes(id)
+)"""),
+    ('ways', WAY_FIELDS, """CREATE TABLE ways (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+)"""),
+    ('ways_nodes', WAY_NODES_FIELDS, """CREATE TABLE ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways(id),
+    FOREIGN KEY (node_id) REFERENCES nodes(id)
+)"""),
+    ('ways_tags', WAY_TAGS_FIELDS, """CREATE TABLE ways_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES ways(id)
+)"""),
+    ('relations', RELATION_FIELDS, """CREATE TABLE relations (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+)"""),
+    ('relations_members', RELATION_MEMBERS_FIELDS, """CREATE TABLE relations_members (
+    id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    ref INTEGER NOT NULL,
+    role TEXT,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES relations(id)
+)"""),
+    ('relations_tags', RELATION_TAGS_FIELDS, """CREATE TABLE relations_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES relations(id)
+)"""),
+]
+
+# Created once the rows are loaded: cheaper than maintaining them per insert
+SQL_INDEXES = [
+    "CREATE INDEX nodes_tags_key ON nodes_tags(key)",
+    "CREATE INDEX nodes_tags_id ON nodes_tags(id)",
+    "CREATE INDEX ways_tags_id_key ON ways_tags(id, key)",
+    "CREATE INDEX ways_tags_key ON ways_tags(key)",
+    "CREATE INDEX ways_nodes_id ON ways_nodes(id)",
+    "CREATE INDEX ways_nodes_node_id ON ways_nodes(node_id)",
+    "CREATE INDEX relations_members_id ON relations_members(id)",
+    "CREATE INDEX relations_members_ref ON relations_members(type, ref)",
+    "CREATE INDEX relations_tags_id_key ON relations_tags(id, key)",
+    "CREATE INDEX relations_tags_key ON relations_tags(key)",
+]
+
+# Bulk load settings: no rollback journal, no fsync, large page cache
+SQL_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode=OFF",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA locking_mode=EXCLUSIVE",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-262144",
+]
+SQL_DONE_PRAGMAS = [
+    "PRAGMA journal_mode=DELETE",
+    "PRAGMA synchronous=FULL",
+    "PRAGMA locking_mode=NORMAL",
+]
+
+###
+# OBJECTIVE: load shaped elements straight into an sqlite database
+###
+class SqliteExporter(ElementExporter):
+    """Bulk load node, way and relation rows into an sqlite database
+
+    The tables are recreated, rows are buffered per table and inserted
+    with executemany, committing every batch_size elements, and the
+    indexes are built after the load. Replaces writing the csv(s) and
+    running sqlite> .import by hand. With spatial=True the R*Tree
+    tables of SpatialIndex are built as well; without, those of a
+    previous export are dropped.
+    """
+
+    def __init__(self, db_path=DB_PATH, validate=False, batch_size=50000,
+                 spatial=False):
+        super(SqliteExporter, self).__init__(validate)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.spatial = spatial
+
+    def __enter__(self):
+        self.db = sqlite3.connect(self.db_path)
+        for pragma in SQL_LOAD_PRAGMAS:
+            self.db.execute(pragma)
+
+        # R*Tree tables of a previous export would no longer match the
+        # rows: they are built again with spatial=True only
+        for table, _ in SPATIAL_TABLES:
+            self.db.execute("DROP TABLE IF EXISTS %s" % table)
+        self.inserts = {}
+        self.rows = {}
+        for table, fields, create in SQL_TABLES:
+            self.db.execute("DROP TABLE IF EXISTS %s" % table)
+            self.db.execute(create)
+            self.inserts[table] = "INSERT INTO %s (%s) VALUES (%s)" % (
+                table, ', '.join('"%s"' % f for f in fields),
+                ', '.join('?' * len(fields)))
+            self.rows[table] = []
+        self.fields = dict((table, fields) for table, fields, _ in SQL_TABLES)
+        self.count = 0
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+                for index in SQL_INDEXES:
+                    self.db.execute(index)
+                self.db.commit()
+                for pragma in SQL_DONE_PRAGMAS:
+                    self.db.execute(pragma)
+                self.db.execute("ANALYZE")
+        finally:
+            self.db.close()
+        if exc_type is None and self.spatial:
+            build_spatial_index(self.db_path)
+        return False
+
+    def _add(self, table, rows):
+        fields = self.fields[table]
+        self.rows[table].extend(tuple(row[f] for f in fields) for row in rows)
+
+    def write_node(self, el):
+        self._add('nodes', (el['node'],))
+        self._add('nodes_tags', el['node_tags'])
+        self._tick()
+
+    def write_way(self, el):
+        self._add('ways', (el['way'],))
+        self._add('ways_nodes', el['way_nodes'])
+        self._add('ways_tags', el['way_tags'])
+        self._tick()
+
+    def write_relation(self, el):
+        self._add('relations', (el['relation'],))
+        self._add('relations_members', el['relation_members'])
+        self._add('relations_tags', el['relation_tags'])
+        self._tick()
+
+    def _tick(self):
+        self.count += 1
+        if self.count % self.batch_size == 0:
+            self.flush()
+
+    def flush(self):
+        """Insert the buffered rows and commit them as one transaction"""
+        for table, _, _ in SQL_TABLES:
+            rows = self.rows[table]
+            if rows:
+                self.db.executemany(self.inserts[table], rows)
+                del rows[:]
+        self.db.commit()
+
+# ================================================== #
+#               Columnar Export                      #
+# ================================================== #
+
+# optional: the columnar export needs pyarrow for Parquet
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COLUMNS_DIR = "columns"
+
+# Column kinds: int64, int32 (uid, version, position), float64, time
+# (seconds since the epoch) and dict, strings stored as int32 codes into a
+# dictionary of distinct values
+COLUMN_TABLES = [
+    ('nodes', [('id', 'int64'), ('lat', 'float64'), ('lon', 'float64'),
+               ('user', 'dict'), ('uid', 'int32'), ('version', 'int32'),
+               ('changeset', 'int64'), ('timestamp', 'time')]),
+    ('nodes_tags', [('id', 'int64'), ('key', 'dict'), ('value', 'dict'),
+                    ('type', 'dict')]),
+    ('ways', [('id', 'int64'), ('user', 'dict'), ('uid', 'int32'),
+              ('version', 'int32'), ('changeset', 'int64'), ('timestamp', 'time')]),
+    ('ways_nodes', [('id', 'int64'), ('node_id', 'int64'), ('position', 'int32')]),
+    ('ways_tags', [('id', 'int64'), ('key', 'dict'), ('value', 'dict'),
+                   ('type', 'dict')]),
+    ('relations', [('id', 'int64'), ('user', 'dict'), ('uid', 'int32'),
+                   ('version', 'int32'), ('changeset', 'int64'),
+                   ('timestamp', 'time')]),
+    ('relations_members', [('id', 'int64'), ('type', 'dict'), ('ref', 'int64'),
+                           ('role', 'dict'), ('position', 'int32')]),
+    ('relations_tags', [('id', 'int64'), ('key', 'dict'), ('value', 'dict'),
+                        ('type', 'dict')]),
+]
+
+# dtype of each column kind in the .npy chunks
+COLUMN_DTYPES = {'int64': 'int64', 'int32': 'int32', 'float64': 'float64',
+                 'time': 'datetime64[s]', 'dict': 'int32'}
+
+###
+# OBJECTIVE: write shaped elements as typed columns (Parquet or .npy chunks)
+###
+class ColumnarExporter(ElementExporter):
+    """Write node, way and relation rows as typed, compact columns
+
+    Rows are buffered per column and flushed every batch_size rows of a
+    table. ids and changesets are int64, uid, version and position int32,
+    lat/lon float64 and timestamps datetime64[s], so nothing has to be
+    CAST when reading them back.
+
+    fmt='parquet' (needs pyarrow) writes one <table>.parquet file per
+    table with one row group per batch; its strings are dictionary
+    encoded by Parquet. fmt='npy' writes <table>/<column>.<chunk>.npy
+    files; dict columns hold int32 codes into <table>/<column>.dict.json.
+    See load_columns() to read them back.
+    """
+
+    def __init__(self, out_dir=COLUMNS_DIR, fmt=None, validate=False,
+                 batch_size=100000):
+        super(ColumnarExporter, self).__init__(validate)
+        if np is None:
+            raise ImportError("the columnar export needs numpy")
+        if fmt is None:
+            fmt = 'parquet' if pyarrow is not None else 'npy'
+        if fmt == 'parquet' and pyarrow is None:
+            raise ImportError("the parquet export needs pyarrow")
+        if fmt not in ('parquet', 'npy'):
+            raise ValueError("unknown columnar format %r" % fmt)
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.batch_size = batch_size
+
+    def __enter__(self):
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        self.columns = dict(COLUMN_TABLES)
+        self.rows = {}
+        self.chunks = {}
+        self.dicts = {}
+        self.writers = {}
+        for table, columns in COLUMN_TABLES:
+            self.rows[table] = []
+            self.chunks[table] = 0
+            path = os.path.join(self.out_dir, table)
+            if self.fmt == 'parquet':
+                self.writers[table] = pyarrow.parquet.ParquetWriter(
+                    path + '.parquet', self._arrow_schema(columns))
+            else:
+                # the chunks of a previous export would be read back with these
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                os.makedirs(path)
+                for name, kind in columns:
+                    if kind == 'dict':
+                        self.dicts[table, name] = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                for table, _ in COLUMN_TABLES:
+                    self.flush(table)
+                for (table, name), codes in self.dicts.iteritems():
+                    values = sorted(codes, key=codes.get)
+                    with open(os.path.join(self.out_dir, table,
+                                           name + '.dict.json'), 'wb') as f:
+                        json.dump(values, f)
+        finally:
+            for writer in self.writers.values():
+                writer.close()
+        return False
+
+    @staticmethod
+    def _arrow_schema(columns):
+        types = {'int64': pyarrow.int64(), 'int32': pyarrow.int32(),
+                 'float64': pyarrow.float64(),
+                 'time': pyarrow.timestamp('s'), 'dict': pyarrow.string()}
+        return pyarrow.schema([(name, types[kind]) for name, kind in columns])
+
+    def _add(self, table, rows):
+        buffered = self.rows[table]
+        buffered.extend(rows)
+        if len(buffered) >= self.batch_size:
+            self.flush(table)
+
+    def write_node(self, el):
+        self._add('nodes', (el['node'],))
+        self._add('nodes_tags', el['node_tags'])
+
+    def write_way(self, el):
+        self._add('ways', (el['way'],))
+        self._add('ways_nodes', el['way_nodes'])
+        self._add('ways_tags', el['way_tags'])
+
+    def write_relation(self, el):
+        self._add('relations', (el['relation'],))
+        self._add('relations_members', el['relation_members'])
+        self._add('relations_tags', el['relation_tags'])
+
+    def _column(self, table, name, kind, values):
+        """numpy array of one column of a batch"""
+        if kind in ('int64', 'int32'):
+            return np.fromiter((int(v) for v in values), kind, len(values))
+        if kind == 'float64':
+            return np.fromiter((float(v) for v in values), np.float64, len(values))
+        if kind == 'time':
+            # 2017-06-26T19:37:54Z
+            return np.array([v.rstrip('Z') for v in values], dtype='datetime64[s]')
+        if self.fmt == 'parquet':
+            return values
+        codes = self.dicts[table, name]
+        return np.fromiter((codes.setdefault(v, len(codes)) for v in values),
+                           np.int32, len(values))
+
+    def flush(self, table):
+        """Write the buffered rows of table as one chunk (row group)"""
+        rows = self.rows[table]
+        if not rows:
+            return
+        arrays = []
+        for name, kind in self.columns[table]:
+            arrays.append(self._column(table, name, kind, [row[name] for row in rows]))
+        if self.fmt == 'parquet':
+            writer = self.writers[table]
+            batch = pyarrow.Table.from_arrays(
+                [pyarrow.array(a, type=field.type)
+                 for a, field in zip(arrays, writer.schema)],
+                schema=writer.schema)
+            writer.write_table(batch)
+        else:
+            chunk = self.chunks[table]
+            for (name, _), array in zip(self.columns[table], arrays):
+                np.save(os.path.join(self.out_dir, table,
+                                     '%s.%05d.npy' % (name, chunk)), array)
+        self.chunks[table] += 1
+        del rows[:]
+
+
+def load_columns(table, out_dir=COLUMNS_DIR, decode=True):
+    """Read back the columns of a table as {column: numpy array}
+
+    With decode=False the dict columns of an .npy export are returned as
+    (codes, dictionary) pairs, which is much cheaper for counting or
+    filtering on keys and users.
+    """
+    path = os.path.join(out_dir, table)
+    if os.path.exists(path + '.parquet'):
+        data = pyarrow.parquet.read_table(path + '.parquet')
+        columns = {}
+        for name, kind in dict(COLUMN_TABLES)[table]:
+            parts = [chunk.to_numpy(zero_copy_only=False)
+                     for chunk in data.column(name).chunks]
+            if not parts:
+                parts = [np.array([], dtype=object if kind == 'dict'
+                                  else COLUMN_DTYPES[kind])]
+            # Parquet stores the timestamps in milliseconds
+            columns[name] = np.concatenate(parts).astype(
+                object if kind == 'dict' else COLUMN_DTYPES[kind])
+        return columns
+    columns = {}
+    chunks = len([f for f in os.listdir(path) if f.startswith('id.')])
+    for name, kind in dict(COLUMN_TABLES)[table]:
+        parts = [np.load(os.path.join(path, '%s.%05d.npy' % (name, chunk)))
+                 for chunk in range(chunks)]
+        if not parts:
+            parts = [np.array([], dtype=COLUMN_DTYPES[kind])]
+        array = np.concatenate(parts)
+        if kind == 'dict':
+            with open(os.path.join(path, name + '.dict.json'), 'rb') as f:
+                dictionary = np.array(json.load(f), dtype=object)
+            array = dictionary[array] if decode else (array, dictionary)
+        columns[name] = array
+    return columns
+
+# ================================================== #
+#               Interned Tag Tables                  #
+# ================================================== #
+TAG_KEYS_PATH = "tag_keys.csv"
+TAG_VALUES_PATH = "tag_values.csv"
+TAG_KEYS_FIELDS = ['id', 'key', 'type']
+TAG_VALUES_FIELDS = ['id', 'value']
+# tag rows of the interned export: ids into tag_keys and tag_values
+INTERNED_TAGS_FIELDS = ['id', 'key_id', 'value_id']
+# fields of each file of CSV_PATHS in the interned export
+INTERNED_CSV_FIELDS = (NODE_FIELDS, INTERNED_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS,
+                       INTERNED_TAGS_FIELDS, RELATION_FIELDS, RELATION_MEMBERS_FIELDS,
+                       INTERNED_TAGS_FIELDS)
+
+
+class TagInterner(object):
+    """Give every distinct (key, type) and every distinct value an integer id
+
+    Ids start at 1 in the order the strings are first seen. Each string
+    is utf-8 encoded once, when it gets its id; the entries seen since
+    the last drain() wait in new_keys and new_values.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.values = {}
+        self.new_keys = []
+        self.new_values = []
+        self.key_rows = []      # (key, type) by id - 1
+        self.value_rows = []    # value by id - 1
+
+    def key_id(self, key, tag_type):
+        key_id = self.keys.get((key, tag_type))
+        if key_id is None:
+            key_id = self.keys[(key, tag_type)] = len(self.keys) + 1
+            row = (_utf8(key), _utf8(tag_type))
+            self.key_rows.append(row)
+            self.new_keys.append((key_id,) + row)
+        return key_id
+
+    def value_id(self, value):
+        value_id = self.values.get(value)
+        if value_id is None:
+            value_id = self.values[value] = len(self.values) + 1
+            row = _utf8(value)
+            self.value_rows.append(row)
+            self.new_values.append((value_id, row))
+        return value_id
+
+    def tag_rows(self, element_id, tags):
+        """(element_id, key_id, value_id) rows of (key, value, type) tags"""
+        keys = self.keys
+        values = self.values
+        rows = []
+        for key, value, tag_type in tags:
+            key_id = keys.get((key, tag_type)) or self.key_id(key, tag_type)
+            value_id = values.get(value) or self.value_id(value)
+            rows.append((element_id, key_id, value_id))
+        return rows
+
+    def decode(self, rows):
+        """(id, key, value, type) rows of interned tag rows"""
+        key_rows = self.key_rows
+        value_rows = self.value_rows
+        decoded = []
+        for element_id, key_id, value_id in rows:
+            key, tag_type = key_rows[key_id - 1]
+            decoded.append((element_id, key, value_rows[value_id - 1], tag_type))
+        return decoded
+
+    def drain(self):
+        """Return and forget the (key, value) entries seen since the last call"""
+        new_keys, new_values = self.new_keys, self.new_values
+        self.new_keys, self.new_values = [], []
+        return new_keys, new_values
+
+
+class InternedCsvExporter(CsvExporter):
+    """CsvExporter writing dictionary encoded tag tables
+
+    Keys and values are interned while the elements are shaped (see
+    TagInterner): the *_tags csv(s) hold (id, key_id, value_id) rows and
+    every distinct (key, type) and value is written once, to tag_keys.csv
+    and tag_values.csv. The other csv(s) are the same as with
+    CsvExporter. Rows are tuples (rows='tuple'). Loaded into sqlite, a
+    GROUP BY key_id, value_id runs on integers and the text is joined
+    back from the two small tables.
+    """
+
+    fields = INTERNED_CSV_FIELDS
+
+    def __init__(self, validate=False, paths=CSV_PATHS, header=True, compress=False,
+                 dict_paths=(TAG_KEYS_PATH, TAG_VALUES_PATH)):
+        super(InternedCsvExporter, self).__init__(validate, paths, header, compress,
+                                                  rows='tuple')
+        if compress:
+            dict_paths = tuple(path + osmio.GZ_SUFFIX for path in dict_paths)
+        self.dict_paths = dict_paths
+        self.interner = TagInterner()
+
+    def __enter__(self):
+        super(InternedCsvExporter, self).__enter__()
+        self.dict_files = [osmio.open_output(path, self.compress)
+                           for path in self.dict_paths]
+        self.files.extend(self.dict_files)
+        keys_file, values_file = self.dict_files
+        self.tag_keys_writer = csv.writer(keys_file)
+        self.tag_values_writer = csv.writer(values_file)
+        if self.header:
+            self.tag_keys_writer.writerow(TAG_KEYS_FIELDS)
+            self.tag_values_writer.writerow(TAG_VALUES_FIELDS)
+        return self
+
+    def shape(self, element):
+        return shape_element_rows(element, self.interner)
+
+    def check(self, el):
+        if self.validate:
+            el = dict(el)
+            for part in ('node_tags', 'way_tags', 'relation_tags'):
+                if part in el:
+                    el[part] = self.interner.decode(el[part])
+        super(InternedCsvExporter, self).check(el)
+
+    def write_shaped(self, tag, el):
+        super(InternedCsvExporter, self).write_shaped(tag, el)
+        if self.interner.new_keys or self.interner.new_values:
+            new_keys, new_values = self.interner.drain()
+            self.tag_keys_writer.writerows(new_keys)
+            self.tag_values_writer.writerows(new_values)
+
+# ================================================== #
+#               Way Geometry                         #
+# ================================================== #
+WAYS_GEOMETRY_PATH = "ways_geometry.csv"
+WAY_GEOMETRY_FIELDS = ['id', 'min_lat', 'min_lon', 'max_lat', 'max_lon',
+                       'centroid_lat', 'centroid_lon', 'length', 'area',
+                       'missing_nodes']
+EARTH_RADIUS = 6371008.8    # meters
+NODE_RECORD = struct.Struct('<qdd')     # id, lat, lon
+# python 2 arrays have no 'q': where a long is 4 bytes the ids are stored
+# as doubles, exact up to 2**53
+NODE_ID_TYPECODE = 'l' if array('l').itemsize == 8 else 'd'
+
+
+class _MappedIds(object):
+    """Sequence of the ids of a memory mapped NODE_RECORD file, for bisect"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // NODE_RECORD.size
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<q', self.data, i * NODE_RECORD.size)[0]
+
+
+###
+# OBJECTIVE: compact node id -> (lat, lon) store
+###
+class NodeIndex(object):
+    """Node coordinates, sorted by id, searched by bisection
+
+    In memory the ids and coordinates are packed in arrays (8 bytes per
+    value instead of a dict entry and three objects per node). With path
+    the (id, lat, lon) records are written to that file and memory mapped
+    once the node phase is over, for extracts larger than the RAM. Nodes
+    come sorted by id in osm files; otherwise they are sorted in freeze().
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.sorted = True
+        self.last_id = None
+        self.frozen = False
+        if path is None:
+            self.ids = array(NODE_ID_TYPECODE)
+            self.coords = array('d')
+        else:
+            self.file = open(path, 'w+b')
+            self.data = None
+
+    def add(self, node_id, lat, lon):
+        if self.frozen:
+            raise ValueError("node %d added after the ways" % node_id)
+        if self.last_id is not None and node_id <= self.last_id:
+            self.sorted = False
+        self.last_id = node_id
+        if self.path is None:
+            self.ids.append(node_id)
+            self.coords.append(lat)
+            self.coords.append(lon)
+        else:
+            self.file.write(NODE_RECORD.pack(node_id, lat, lon))
+
+    def freeze(self):
+        """End of the node phase: sort and map the index for the lookups"""
+        if self.frozen:
+            return
+        self.frozen = True
+        if self.path is None:
+            if not self.sorted:
+                records = sorted(zip(self.ids, self.coords[::2], self.coords[1::2]))
+                self.ids = array(self.ids.typecode, (r[0] for r in records))
+                self.coords = array('d')
+                for _, lat, lon in records:
+                    self.coords.append(lat)
+                    self.coords.append(lon)
+            return
+        self.file.flush()
+        if not self.sorted:
+            self.file.seek(0)
+            records = sorted(NODE_RECORD.unpack(chunk) for chunk in
+                             iter(lambda: self.file.read(NODE_RECORD.size), ''))
+            self.file.seek(0)
+            for record in records:
+                self.file.write(NODE_RECORD.pack(*record))
+            self.file.flush()
+        if os.path.getsize(self.path):
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.ids = _MappedIds(self.data)
+        else:
+            self.ids = ()
+
+    def get(self, node_id):
+        """(lat, lon) of a node, None if it is not in the index"""
+        ids = self.ids
+        i = bisect.bisect_left(ids, node_id)
+        if i == len(ids) or ids[i] != node_id:
+            return None
+        if self.path is None:
+            return self.coords[2 * i], self.coords[2 * i + 1]
+        return NODE_RECORD.unpack_from(self.data, i * NODE_RECORD.size)[1:]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def close(self):
+        if self.path is not None:
+            if self.data is not None:
+                self.data.close()
+            self.file.close()
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Distance in meters between two points"""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    h = (math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) *
+         math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+###
+# OBJECTIVE: bbox, centroid, length and area of a way
+###
+def way_geometry(coords):
+    """Geometry of a way given its [(lat, lon), ...]
+
+    length is in meters (haversine). A closed ring (first point == last
+    point) also gets its area in m2 and its area centroid, computed on a
+    local equirectangular projection; other ways get area 0 and the mean
+    of their points as centroid.
+    """
+    lats = [lat for lat, _ in coords]
+    lons = [lon for _, lon in coords]
+    length = 0.0
+    for (lat1, lon1), (lat2, lon2) in zip(coords, coords[1:]):
+        length += haversine(lat1, lon1, lat2, lon2)
+
+    centroid_lat = sum(lats) / len(lats)
+    centroid_lon = sum(lons) / len(lons)
+    area = 0.0
+    if len(coords) >= 4 and coords[0] == coords[-1]:
+        # shoelace formula, in meters around the first point
+        lat0, lon0 = coords[0]
+        kx = EARTH_RADIUS * math.cos(math.radians(lat0)) * math.pi / 180
+        ky = EARTH_RADIUS * math.pi / 180
+        points = [((lon - lon0) * kx, (lat - lat0) * ky) for lat, lon in coords]
+        cross_sum = cx = cy = 0.0
+        for (x1, y1), (x2, y2) in zip(points, points[1:]):
+            cross = x1 * y2 - x2 * y1
+            cross_sum += cross
+            cx += (x1 + x2) * cross
+            cy += (y1 + y2) * cross
+        if cross_sum:
+            area = abs(cross_sum) / 2
+            centroid_lat = lat0 + cy / (3 * cross_sum) / ky
+            centroid_lon = lon0 + cx / (3 * cross_sum) / kx
+
+    return {'min_lat': min(lats), 'min_lon': min(lons),
+            'max_lat': max(lats), 'max_lon': max(lons),
+            'centroid_lat': centroid_lat, 'centroid_lon': centroid_lon,
+            'length': length, 'area': area}
+
+
+###
+# OBJECTIVE: add the way geometry to an export
+###
+class GeometryExporter(ElementExporter):
+    """Wrap an exporter, indexing the nodes and writing the way geometry
+
+    Rows go to the wrapped exporter unchanged. Node coordinates are kept
+    in a NodeIndex (memory mapped at index_path if given), and each way
+    gets a row in ways_geometry.csv with its bbox, centroid, length and
+    area, so no join of ways_nodes with nodes is needed for them.
+    """
+
+    def __init__(self, exporter, path=WAYS_GEOMETRY_PATH, index_path=None):
+        super(GeometryExporter, self).__init__(exporter.validate)
+        if getattr(exporter, 'rows', 'dict') != 'dict':
+            raise ValueError("the way geometry reads dict rows (rows='dict')")
+        self.exporter = exporter
+        self.path = path
+        self.index_path = index_path
+
+    def __enter__(self):
+        self.exporter.__enter__()
+        self.index = NodeIndex(self.index_path)
+        self.file = open(self.path, 'wb')
+        self.geometry_writer = UnicodeDictWriter(self.file, WAY_GEOMETRY_FIELDS)
+        self.geometry_writer.writeheader()
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self.file.close()
+            self.index.close()
+        finally:
+            self.exporter.__exit__(*exc_info)
+        return False
+
+    def write_node(self, el):
+        node = el['node']
+        self.index.add(int(node['id']), float(node['lat']), float(node['lon']))
+        self.exporter.write_node(el)
+
+    def write_way(self, el):
+        self.exporter.write_way(el)
+        index = self.index
+        index.freeze()
+        coords = []
+        for nd in el['way_nodes']:
+            point = index.get(int(nd['node_id']))
+            if point is not None:
+                coords.append(point)
+        row = way_geometry(coords) if coords else {}
+        row['id'] = el['way']['id']
+        row['missing_nodes'] = len(el['way_nodes']) - len(coords)
+        self.geometry_writer.writerow(row)
+
+    def write_relation(self, el):
+        self.exporter.write_relation(el)
+
+# ================================================== #
+#               Export Summary                       #
+# ================================================== #
+SUMMARY_JSON_PATH = "summary.json"
+SUMMARY_TOP_N = 20
+# registers of a HyperLogLog: 2 ** precision, standard error 1.04 / sqrt(2 ** precision)
+HLL_PRECISION = 10
+# tags whose values are summarised as numbers (CAST(value AS FLOAT))
+NUMERIC_KEYS = ('height', 'building:levels')
+# position of uid in the tuple rows of shape_element_rows
+UID_INDEX = {'node': NODE_FIELDS.index('uid'), 'way': WAY_FIELDS.index('uid'),
+             'relation': RELATION_FIELDS.index('uid')}
+USER_INDEX = {'node': NODE_FIELDS.index('user'), 'way': WAY_FIELDS.index('user'),
+              'relation': RELATION_FIELDS.index('user')}
+
+
+###
+# OBJECTIVE: approximate number of distinct values in bounded memory
+###
+class HyperLogLog(object):
+    """Cardinality estimate of a stream of strings (HyperLogLog)
+
+    Uses 2 ** precision one byte registers whatever the number of
+    values; the estimate is within about 1.04 / sqrt(2 ** precision) of
+    the true count (3% with the default precision).
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        """Add a str (utf-8) value"""
+        x = struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+        index = x & ((1 << self.precision) - 1)
+        bits = 64 - self.precision
+        # position of the first 1 bit of the remaining bits
+        rank = bits - (x >> self.precision).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for index, rank in enumerate(other.registers):
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+
+    def __len__(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count('\0')
+        if estimate <= 2.5 * m and zeros:
+            # small range correction: linear counting
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+###
+# OBJECTIVE: running count, min, max and mean of a numeric tag
+###
+class NumericSummary(object):
+    """Count, min, max and mean of the values that parse as floats
+
+    Values float() rejects ('3 m', '2;3'...) are counted as invalid with
+    their top examples, where CAST(value AS FLOAT) would silently read
+    them as their numeric prefix.
+    """
+
+    def __init__(self, top=SUMMARY_TOP_N):
+        self.top = top
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.invalid = SpaceSaving(2 * top)
+
+    def add(self, value):
+        try:
+            number = float(value)
+        except ValueError:
+            self.invalid.add(value)
+            return
+        if math.isnan(number) or math.isinf(number):
+            self.invalid.add(value)
+            return
+        self.count += 1
+        self.total += number
+        if self.min is None or number < self.min:
+            self.min = number
+        if self.max is None or number > self.max:
+            self.max = number
+
+    def result(self):
+        return {'count': self.count, 'min': self.min, 'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'invalid': sum(self.invalid.counts.values()),
+                'invalid_examples': self.invalid.top(self.top)}
+
+
+###
+# OBJECTIVE: value counts of one tag key
+###
+class KeySummary(object):
+    """Number of tags, distinct values (HyperLogLog) and top values of a key"""
+
+    def __init__(self, top=SUMMARY_TOP_N):
+        self.top = top
+        self.count = 0
+        self.distinct = HyperLogLog()
+        self.values = SpaceSaving(2 * top)
+
+    def add(self, value):
+        self.count += 1
+        self.distinct.add(value)
+        self.values.add(value)
+
+    def result(self):
+        return {'count': self.count, 'distinct_values': len(self.distinct),
+                'top_values': self.values.top(self.top)}
+
+
+###
+# OBJECTIVE: summary statistics computed while the rows are written
+###
+class SummaryExporter(ElementExporter):
+    """Wrap an exporter, aggregating the rows it writes
+
+    Rows go to the wrapped exporter unchanged. Along the way are counted:
+    the elements by type, the edits of every user, the tags of every key
+    of each tag table with the distinct (HyperLogLog) and top values of
+    the key, and the numeric statistics of NUMERIC_KEYS. The values are the cleaned ones,
+    as written. result() is JSON serialisable and written to path on
+    exit, so that the report reads it instead of querying the tables.
+    """
+
+    TAG_TABLES = {'node': 'nodes_tags', 'way': 'ways_tags',
+                  'relation': 'relations_tags'}
+
+    def __init__(self, exporter, path=SUMMARY_JSON_PATH, top=SUMMARY_TOP_N):
+        super(SummaryExporter, self).__init__(exporter.validate)
+        self.exporter = exporter
+        self.path = path
+        self.top = top
+        self.rows = getattr(exporter, 'rows', 'dict')
+        self.elements = defaultdict(int)
+        self.users = {}
+        self.keys = dict((tag, {}) for tag in self.TAG_TABLES)
+        self.numeric = dict((key, NumericSummary(top)) for key in NUMERIC_KEYS)
+
+    def __enter__(self):
+        self.exporter.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if exc_info[0] is None:
+                self.write_json(self.path)
+        finally:
+            self.exporter.__exit__(*exc_info)
+        return False
+
+    def shape(self, element):
+        return self.exporter.shape(element)
+
+    def check(self, el):
+        self.exporter.check(el)
+
+    def write_shaped(self, tag, el):
+        self.exporter.write_shaped(tag, el)
+        self.add(tag, el)
+
+    def write_node(self, el):
+        self.write_shaped('node', el)
+
+    def write_way(self, el):
+        self.write_shaped('way', el)
+
+    def write_relation(self, el):
+        self.write_shaped('relation', el)
+
+    def add(self, tag, el):
+        self.elements[tag] += 1
+        row = el[tag]
+        if row.__class__ is tuple:
+            uid, user = row[UID_INDEX[tag]], row[USER_INDEX[tag]]
+        else:
+            uid, user = row['uid'], row['user']
+        edits = self.users.get(uid)
+        if edits is None:
+            self.users[uid] = [_utf8(user), 1]
+        else:
+            edits[1] += 1
+
+        tags = el[tag + '_tags']
+        interner = getattr(self.exporter, 'interner', None)
+        if interner is not None:
+            tags = interner.decode(tags)
+        keys = self.keys[tag]
+        numeric = self.numeric
+        for tag_row in tags:
+            if tag_row.__class__ is tuple:
+                element_id, key, value, tag_type = tag_row
+            else:
+                # utf-8, as the tuple rows: same summary with either rows
+                key, value, tag_type = (_utf8(tag_row['key']), _utf8(tag_row['value']),
+                                        _utf8(tag_row['type']))
+            summary = keys.get((key, tag_type))
+            if summary is None:
+                summary = keys[(key, tag_type)] = KeySummary(self.top)
+            summary.add(value)
+            full_key = key if tag_type == 'regular' else tag_type + ':' + key
+            if full_key in numeric:
+                numeric[full_key].add(value)
+
+    def result(self):
+        users = sorted(self.users.iteritems(), key=lambda kv: (-kv[1][1], kv[0]))
+        tables = {}
+        for tag, table in self.TAG_TABLES.iteritems():
+            keys = sorted(self.keys[tag].iteritems(), key=lambda kv: (-kv[1].count, kv[0]))
+            tables[table] = [dict(summary.result(), key=key, type=tag_type)
+                                  for (key, tag_type), summary in keys]
+        return {'elements': dict(self.elements),
+                'users': {'distinct': len(self.users),
+                          'edits': [{'uid': uid, 'user': user, 'count': count}
+                                    for uid, (user, count) in users]},
+                'tags': tables,
+                'numeric': dict((key, summary.result())
+                                for key, summary in self.numeric.iteritems())}
+
+    def write_json(self, path=SUMMARY_JSON_PATH):
+        with open(path, 'wb') as f:
+            json.dump(self.result(), f, indent=2, sort_keys=True)
+
+# ================================================== #
+#               Spatial Index                        #
+# ================================================== #
+
+# R*Tree of the node positions and of the way bboxes
+SPATIAL_TABLES = [
+    ('nodes_rtree', "CREATE VIRTUAL TABLE nodes_rtree USING rtree("
+                    "id, min_lat, max_lat, min_lon, max_lon)"),
+    ('ways_rtree', "CREATE VIRTUAL TABLE ways_rtree USING rtree("
+                   "id, min_lat, max_lat, min_lon, max_lon)"),
+]
+SQL_NODE_BOXES = "SELECT id, lat, lat, lon, lon FROM nodes WHERE lat IS NOT NULL"
+SQL_WAY_BOXES = """SELECT wn.id, MIN(n.lat), MAX(n.lat), MIN(n.lon), MAX(n.lon)
+FROM ways_nodes wn JOIN nodes n ON n.id = wn.node_id"""
+# sqlite accepts at most 999 parameters per statement
+SQL_MAX_PARAMS = 900
+
+###
+# OBJECTIVE: build the R*Tree tables of an sqlite export
+###
+def build_spatial_index(db_path=DB_PATH):
+    """(Re)create nodes_rtree and ways_rtree in an sqlite export
+
+    Runs once after the load (SqliteExporter(spatial=True) calls it):
+    the way bboxes come from one grouped join of ways_nodes with nodes.
+    """
+    db = sqlite3.connect(db_path)
+    try:
+        for table, create in SPATIAL_TABLES:
+            db.execute("DROP TABLE IF EXISTS %s" % table)
+            db.execute(create)
+        db.execute("INSERT INTO nodes_rtree " + SQL_NODE_BOXES)
+        db.execute("INSERT INTO ways_rtree " + SQL_WAY_BOXES + " GROUP BY wn.id")
+        db.commit()
+    finally:
+        db.close()
+
+
+def has_spatial_index(db):
+    tables = set(name for name, in db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    return all(table in tables for table, _ in SPATIAL_TABLES)
+
+
+###
+# OBJECTIVE: bounding box and radius queries over nodes and ways
+###
+class SpatialIndex(object):
+    """Query the nodes and ways of an sqlite export by location
+
+    Every query is an R*Tree lookup followed by an exact test on the
+    candidates, so its cost depends on the number of results and not on
+    the size of the extract. Results are dicts with type ('node' or
+    'way'), id, the position (lat/lon) of a node or the bbox of a way,
+    and the tags, keyed like in the osm file (addr:street...).
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db = sqlite3.connect(db_path)
+        if not has_spatial_index(self.db):
+            self.db.close()
+            raise ValueError("%s has no spatial index, see build_spatial_index"
+                             % db_path)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon, types=('node', 'way')):
+        """Nodes inside the box and ways whose bbox intersects it"""
+        results = []
+        if 'node' in types:
+            # the R*Tree stores 32 bit floats: exact test on the nodes table
+            rows = self.db.execute(
+                """SELECT n.id, n.lat, n.lon FROM nodes_rtree r
+                JOIN nodes n ON n.id = r.id
+                WHERE r.max_lat >= ? AND r.min_lat <= ?
+                AND r.max_lon >= ? AND r.min_lon <= ?
+                AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?""",
+                (min_lat, max_lat, min_lon, max_lon,
+                 min_lat, max_lat, min_lon, max_lon))
+            results.extend({'type': 'node', 'id': node_id, 'lat': lat, 'lon': lon}
+                           for node_id, lat, lon in rows)
+        if 'way' in types:
+            rows = self.db.execute(
+                """SELECT id, min_lat, max_lat, min_lon, max_lon FROM ways_rtree
+                WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?""",
+                (min_lat, max_lat, min_lon, max_lon))
+            results.extend({'type': 'way', 'id': way_id,
+                            'min_lat': lat0, 'max_lat': lat1,
+                            'min_lon': lon0, 'max_lon': lon1}
+                           for way_id, lat0, lat1, lon0, lon1 in rows)
+        self._add_tags(results)
+        return results
+
+    def radius(self, lat, lon, meters, types=('node', 'way')):
+        """Nodes and ways (by their bbox) within meters of (lat, lon),
+        nearest first, with their distance"""
+        dlat = math.degrees(meters / EARTH_RADIUS)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-12)
+        results = []
+        for result in self.bbox(lat - dlat, lon - dlon, lat + dlat, lon + dlon, types):
+            if result['type'] == 'node':
+                near_lat, near_lon = result['lat'], result['lon']
+            else:
+                # nearest point of the bbox
+                near_lat = min(max(lat, result['min_lat']), result['max_lat'])
+                near_lon = min(max(lon, result['min_lon']), result['max_lon'])
+            distance = haversine(lat, lon, near_lat, near_lon)
+            if distance <= meters:
+                result['distance'] = distance
+                results.append(result)
+        results.sort(key=operator.itemgetter('distance'))
+        return results
+
+    def _add_tags(self, results):
+        for element_type, table in (('node', 'nodes_tags'), ('way', 'ways_tags')):
+            by_id = dict((r['id'], r) for r in results if r['type'] == element_type)
+            for r in by_id.itervalues():
+                r['tags'] = {}
+            ids = list(by_id)
+            for i in range(0, len(ids), SQL_MAX_PARAMS):
+                chunk = ids[i:i + SQL_MAX_PARAMS]
+                rows = self.db.execute(
+                    "SELECT id, key, value, type FROM %s WHERE id IN (%s)"
+                    % (table, ', '.join('?' * len(chunk))), chunk)
+                for element_id, key, value, tag_type in rows:
+                    if tag_type != 'regular':
+                        key = tag_type + ':' + key
+                    by_id[element_id]['tags'][key] = value
+
+# ================================================== #
+#               Incremental Update                   #
+# ================================================== #
+
+# parent table and child tables of each element type
+CHANGE_TABLES = {
+    'node': ('nodes', ('nodes_tags',)),
+    'way': ('ways', ('ways_nodes', 'ways_tags')),
+    'relation': ('relations', ('relations_members', 'relations_tags')),
+}
+CHANGE_ACTIONS = ('create', 'modify', 'delete')
+
+###
+# OBJECTIVE: iterate over the changes of an OsmChange (.osc) file
+###
+def iter_changes(osc_file):
+    """Yield (action, element) for every element of an OsmChange file
+
+    action is create, modify or delete. Elements are cleared once used,
+    like in ElementStream, so the diff is never held in memory.
+    """
+    source = osmio.open_osm(osc_file) if isinstance(osc_file, basestring) else osc_file
+    try:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        action = None
+        depth = 0
+        for event, elem in context:
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    action = elem.tag
+                continue
+            depth -= 1
+            if depth == 1 and action in CHANGE_ACTIONS and elem.tag in CHANGE_TABLES:
+                yield action, elem
+                elem.clear()
+            elif depth == 0:
+                elem.clear()
+                root.clear()
+    finally:
+        if source is not osc_file:
+            source.close()
+
+
+###
+# OBJECTIVE: apply OsmChange diffs to the sqlite export
+###
+class SqliteUpdater(ElementExporter):
+    """Upsert and delete the rows of changed elements in an sqlite export
+
+    The database is the one written by SqliteExporter (its indexes on the
+    ids make every change a few lookups). Changed elements go through
+    shape_element and the validation like in a full export. A change is
+    skipped when the database already holds that version of the element
+    or a newer one. All the changes of a diff are one transaction. The
+    R*Tree tables of SpatialIndex, if built, are kept up to date: when a
+    node is moved or deleted, the bboxes of the ways using it are
+    computed again.
+    """
+
+    def __init__(self, db_path=DB_PATH, validate=False):
+        super(SqliteUpdater, self).__init__(validate)
+        self.db_path = db_path
+        self.counts = defaultdict(int)
+
+    def __enter__(self):
+        self.db = sqlite3.connect(self.db_path)
+        self.spatial = has_spatial_index(self.db)
+        self.fields = dict((table, fields) for table, fields, _ in SQL_TABLES)
+        self.inserts = dict(
+            (table, "INSERT INTO %s (%s) VALUES (%s)" % (
+                table, ', '.join('"%s"' % f for f in fields),
+                ', '.join('?' * len(fields))))
+            for table, fields, _ in SQL_TABLES)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.db.commit()
+            else:
+                self.db.rollback()
+        finally:
+            self.db.close()
+        return False
+
+    def stored_version(self, tag, element_id):
+        """Version of the element in the database, None if it is not there"""
+        table = CHANGE_TABLES[tag][0]
+        row = self.db.execute("SELECT version FROM %s WHERE id = ?" % table,
+                              (element_id,)).fetchone()
+        return int(row[0]) if row is not None and row[0] is not None else None
+
+    def apply(self, action, element):
+        """Apply one change; returns False when it is stale and skipped"""
+        tag = element.tag
+        element_id = int(element.attrib['id'])
+        version = element.attrib.get('version')
+        stored = self.stored_version(tag, element_id)
+        if version is not None and stored is not None:
+            version = int(version)
+            # a delete carries the version it removes, later than the stored one
+            if stored > version or (stored == version and action != 'delete'):
+                self.counts['skipped'] += 1
+                return False
+
+        if action == 'delete':
+            if stored is None:
+                # already deleted, or never exported
+                self.counts['skipped'] += 1
+                return False
+            position = self.node_position(element_id) if tag == 'node' else None
+            self.remove(tag, element_id)
+        else:
             el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+            if not el:
+                return False
+            self.check(el)
+            position = self.node_position(element_id) if tag == 'node' else None
+            self.remove(tag, element_id)
+            self.write_shaped(tag, el)
+        if self.spatial and tag == 'node' and \
+                position != self.node_position(element_id):
+            self.update_way_boxes(element_id)
+        self.counts[action] += 1
+        return True
+
+    def node_position(self, node_id):
+        """(lat, lon) of a node in the database, None if it is not there"""
+        return self.db.execute("SELECT lat, lon FROM nodes WHERE id = ?",
+                               (node_id,)).fetchone()
+
+    def update_way_boxes(self, node_id):
+        """Compute again the ways_rtree bboxes of the ways using node_id"""
+        way_ids = [way_id for way_id, in self.db.execute(
+            "SELECT DISTINCT id FROM ways_nodes WHERE node_id = ?", (node_id,))]
+        for way_id in way_ids:
+            self.db.execute("DELETE FROM ways_rtree WHERE id = ?", (way_id,))
+            self.db.execute("INSERT INTO ways_rtree " + SQL_WAY_BOXES +
+                            " WHERE wn.id = ? GROUP BY wn.id", (way_id,))
+
+    def remove(self, tag, element_id):
+        table, children = CHANGE_TABLES[tag]
+        for child in children:
+            self.db.execute("DELETE FROM %s WHERE id = ?" % child, (element_id,))
+        self.db.execute("DELETE FROM %s WHERE id = ?" % table, (element_id,))
+        if self.spatial and tag in ('node', 'way'):
+            self.db.execute("DELETE FROM %s_rtree WHERE id = ?" % table,
+                            (element_id,))
+
+    def _insert(self, table, rows):
+        fields = self.fields[table]
+        self.db.executemany(self.inserts[table],
+                            [tuple(row[f] for f in fields) for row in rows])
+
+    def write_node(self, el):
+        self._insert('nodes', (el['node'],))
+        self._insert('nodes_tags', el['node_tags'])
+        if self.spatial:
+            self.db.execute("INSERT INTO nodes_rtree " + SQL_NODE_BOXES +
+                            " AND id = ?", (el['node']['id'],))
+
+    def write_way(self, el):
+        self._insert('ways', (el['way'],))
+        self._insert('ways_nodes', el['way_nodes'])
+        self._insert('ways_tags', el['way_tags'])
+        if self.spatial:
+            # bbox from the nodes already in the database
+            self.db.execute("INSERT INTO ways_rtree " + SQL_WAY_BOXES +
+                            " WHERE wn.id = ? GROUP BY wn.id", (el['way']['id'],))
+
+    def write_relation(self, el):
+        self._insert('relations', (el['relation'],))
+        self._insert('relations_members', el['relation_members'])
+        self._insert('relations_tags', el['relation_tags'])
+
+
+def apply_change(osc_file, db_path=DB_PATH, validate=False):
+    """Apply an OsmChange (.osc, .osc.gz...) file to the sqlite export
+
+    Refreshes an export built with process_map(..., db_path=...) at a
+    cost proportional to the size of the diff. Returns the number of
+    created, modified, deleted and skipped (stale) elements.
+    """
+    with SqliteUpdater(db_path, validate) as updater:
+        for action, element in iter_changes(osc_file):
+            updater.apply(action, element)
+    return dict(updater.counts)
+
+# ================================================== #
+#               Parallel Export                      #
+# ================================================== #
+
+# start of a top level element: nd, tag and member children never match
+TOP_LEVEL_RE = re.compile(r'<(?:node|way|relation)[\s/>]')
+SHARD_SCAN_SIZE = 1 << 20
+
+###
+# OBJECTIVE: split an osm file in byte ranges at top level element boundaries
+###
+def find_shards(file_in, count):
+    """Return [(start, end), ...] byte ranges covering the top level elements
+
+    Every range starts on a '<node', '<way' or '<relation' and ends where
+    the next range starts (or on '</osm>' for the last one), so each shard
+    is a well formed sequence of complete elements.
+    """
+    size = os.path.getsize(file_in)
+    boundaries = []
+    with open(file_in, 'rb') as f:
+        for i in range(count):
+            pos = _next_boundary(f, size * i // count)
+            if pos is None:
+                break
+            if not boundaries or pos > boundaries[-1]:
+                boundaries.append(pos)
+
+        # the last shard stops before the closing root tag
+        tail = max(0, size - SHARD_SCAN_SIZE)
+        f.seek(tail)
+        end = f.read().rfind('</osm>')
+        end = tail + end if end != -1 else size
+
+    if not boundaries:
+        return []
+    boundaries.append(end)
+    return zip(boundaries[:-1], boundaries[1:])
+
+
+def _next_boundary(f, offset):
+    """Offset of the first top level element starting at or after offset"""
+    overlap = 16  # longest marker is '<relation ' (10 bytes)
+    f.seek(offset)
+    while True:
+        chunk = f.read(SHARD_SCAN_SIZE)
+        if not chunk:
+            return None
+        m = TOP_LEVEL_RE.search(chunk)
+        if m:
+            return offset + m.start()
+        if len(chunk) <= overlap:
+            return None
+        offset += len(chunk) - overlap
+        f.seek(offset)
+
+
+###
+# OBJECTIVE: file-like view of one shard wrapped in an <osm> root element
+###
+class ShardReader(object):
+    """Read bytes [start, end) of an osm file as a standalone osm document"""
+
+    def __init__(self, file_in, start, end):
+        self.f = open(file_in, 'rb')
+        self.f.seek(start)
+        self.end = end
+        self.remaining = end - start
+        self.pending = ['<?xml version="1.0" encoding="UTF-8"?>\n<osm>']
+
+    def tell(self):
+        """Offset in the osm file of the next byte to read"""
+        return self.end - self.remaining
+
+    def read(self, size=-1):
+        if self.pending:
+            return self.pending.pop()
+        if self.remaining > 0:
+            if size < 0 or size > self.remaining:
+                size = self.remaining
+            data = self.f.read(size)
+            self.remaining -= len(data)
+            if not data:
+                self.remaining = 0
+            else:
+                return data
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            return '</osm>'
+        return ''
+
+
+def _shard_paths(tmp_dir, index):
+    return tuple(os.path.join(tmp_dir, '%05d.%s' % (index, os.path.basename(path)))
+                 for path in CSV_PATHS)
+
+
+def _export_shard(args):
+    """Process pool worker: export one shard to its partial csv(s)"""
+    file_in, start, end, validate, paths, compress, rows = args
+    with CsvExporter(validate, paths=paths, header=False, compress=compress,
+                     rows=rows) as exporter:
+        for element in get_element(ShardReader(file_in, start, end),
+                                   tags=EXPORT_TAGS):
+            exporter.write(element)
+    # the worker's FastValidator comes back for its report
+    return exporter.paths, validate
+
+
+###
+# OBJECTIVE: export shards in a process pool and merge the partial csv(s)
+###
+def process_map_parallel(file_in, validate, processes=None, shards_per_process=4,
+                         compress=False, rows='dict'):
+    """Export file_in to the csv(s) using a pool of processes
+
+    The file is cut into byte ranges at element boundaries (find_shards),
+    every worker writes the partial csv(s) of its shard, and the partial
+    files are concatenated in file order behind the csv headers, so the
+    row order is the same as with process_map. With compress=True the
+    partial files are gzip members, and their concatenation is a valid
+    gzip file.
+    """
+    if osmio.is_compressed(file_in):
+        raise ValueError("the parallel export needs an uncompressed .osm file "
+                         "(byte ranges of a compressed stream cannot be read)")
+    if pbf.is_pbf(file_in):
+        raise ValueError("the parallel export reads .osm xml; .osm.pbf blobs "
+                         "are already decoded in parallel by process_map")
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    shards = find_shards(file_in, processes * shards_per_process)
+
+    tmp_dir = tempfile.mkdtemp(prefix='osm_shards_',
+                               dir=os.path.dirname(os.path.abspath(NODES_PATH)))
+    try:
+        jobs = [(file_in, start, end, validate, _shard_paths(tmp_dir, i), compress, rows)
+                for i, (start, end) in enumerate(shards)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            # imap keeps the shard order
+            results = list(pool.imap(_export_shard, jobs))
+        finally:
+            pool.close()
+            pool.join()
+
+        if isinstance(validate, FastValidator):
+            for _, shard_validator in results:
+                validate.merge(shard_validator)
+
+        paths = CsvExporter(compress=compress).paths
+        for i, path in enumerate(paths):
+            with open(path, 'wb') as out:
+                # header, then the partial files as they are
+                if compress:
+                    header = gzip.GzipFile(fileobj=out, mode='wb',
+                                           compresslevel=osmio.GZIP_LEVEL)
+                    csv.writer(header).writerow(CSV_FIELDS[i])
+                    header.close()
+                else:
+                    csv.writer(out).writerow(CSV_FIELDS[i])
+                for shard_paths, _ in results:
+                    with open(shard_paths[i], 'rb') as part:
+                        shutil.copyfileobj(part, out, 1 << 20)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# ================================================== #
+#               Checkpoint and Resume                #
+# ================================================== #
+CHECKPOINT_PATH = "process_map.checkpoint"
+CHECKPOINT_EVERY = 100000       # elements
+# how far before the checkpointed read position the resumed parse starts
+# (doubled until the checkpointed element is found)
+CHECKPOINT_SLACK = 1 << 20
+
+
+def load_checkpoint(path, file_in):
+    """Checkpoint of an interrupted export of file_in, None if there is none"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        state = json.load(f)
+    stat = os.stat(file_in)
+    if (state['input'] != os.path.abspath(file_in) or state['size'] != stat.st_size
+            or state['mtime'] != stat.st_mtime):
+        raise ValueError("%s is the checkpoint of another input (or %s changed)"
+                         % (path, file_in))
+    return state
+
+
+def save_checkpoint(path, state):
+    """Write the checkpoint atomically: a crash leaves the old one or the new one"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)     # no atomic replace on windows with python 2
+    os.rename(tmp_path, path)
+
+
+def _resume_elements(file_in, start, end, position, last):
+    """(reader, elements) continuing the export right after element last
+
+    The parse starts CHECKPOINT_SLACK bytes before the checkpointed read
+    position (the parser reads ahead of the element it hands out) and
+    skips the elements up to last, found by type and id alone: the input
+    needs not be sorted. last ended before the checkpointed position, so
+    once the parse has read the slack past it (more than the parser read
+    buffer) last is before the start, and the slack is doubled; from the
+    start of the file the search goes on to the end.
+    """
+    last_tag, last_id = last
+    slack = CHECKPOINT_SLACK
+    with open(file_in, 'rb') as f:
+        while True:
+            offset = start
+            if position - slack > start:
+                offset = _next_boundary(f, position - slack)
+            reader = ShardReader(file_in, offset, end)
+            elements = iter(ElementStream(reader, tags=EXPORT_TAGS))
+            for element in elements:
+                if element.tag == last_tag and element.attrib['id'] == last_id:
+                    return reader, elements
+                if offset > start and reader.tell() > position + slack:
+                    break
+            if offset == start:
+                raise ValueError("element %s %s of the checkpoint not found in %s"
+                                 % (last[0], last[1], file_in))
+            slack *= 2
+
+
+###
+# OBJECTIVE: process_map that can be resumed after a crash
+###
+def process_map_resumable(file_in, validate, checkpoint_path=CHECKPOINT_PATH,
+                          every=CHECKPOINT_EVERY, rows='dict'):
+    """Export file_in to the csv(s), saving a checkpoint every `every` elements
+
+    A checkpoint holds the last exported element, the read position in
+    file_in and the size of every csv, all flushed to disk (fsync) first.
+    If a checkpoint of file_in exists the run resumes from it: the csv(s)
+    are truncated back to the checkpointed sizes, which drops any row
+    written after it (a half written one included), and the export goes
+    on right after the checkpointed element, so no row is lost or
+    written twice. The checkpoint is removed once the export is complete.
+    A checkpoint whose csv(s) are missing is ignored and the export starts
+    over. The input needs not be sorted by type and id (Overpass "out qt",
+    hand edited files): the checkpointed element is looked up by type and
+    id near the checkpointed position. A FastValidator only reports on the
+    elements of the last run.
+    """
+    if osmio.is_compressed(file_in) or pbf.is_pbf(file_in):
+        raise ValueError("checkpoints need an uncompressed .osm file")
+    shards = find_shards(file_in, 1)
+    if not shards:
+        return
+    (start, end), = shards
+
+    state = load_checkpoint(checkpoint_path, file_in)
+    if state is not None:
+        missing = [path for path in CSV_PATHS if not os.path.exists(path)]
+        if missing:
+            print >> sys.stderr, "checkpoint %s ignored, missing: %s" % (
+                checkpoint_path, ', '.join(missing))
+            state = None
+    if state is None:
+        exporter = CsvExporter(validate, rows=rows)
+        reader = ShardReader(file_in, start, end)
+        elements = iter(ElementStream(reader, tags=EXPORT_TAGS))
+        count = 0
+    else:
+        for path, size in zip(CSV_PATHS, state['outputs']):
+            if os.path.getsize(path) < size:
+                raise ValueError("%s is shorter than in the checkpoint" % path)
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+        exporter = CsvExporter(validate, header=False, rows=rows, append=True)
+        reader, elements = _resume_elements(file_in, start, end,
+                                            state['position'], state['last'])
+        count = state['elements']
+
+    stat = os.stat(file_in)
+    with exporter:
+        for element in elements:
+            exporter.write(element)
+            count += 1
+            if count % every == 0:
+                for f in exporter.files:
+                    f.flush()
+                    os.fsync(f.fileno())
+                save_checkpoint(checkpoint_path, {
+                    'input': os.path.abspath(file_in),
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'elements': count,
+                    'last': [element.tag, element.attrib['id']],
+                    'position': reader.tell(),
+                    'outputs': [f.tell() for f in exporter.files],
+                })
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return count
+
+# ================================================== #
+#               Single Pass Audit                    #
+# ================================================== #
+
+###
+# OBJECTIVE: base class of the audit visitors run by audit_map
+###
+class AuditVisitor(object):
+    """Collect audit results from the top level elements of an osm file
+
+    audit_map calls start() once with the root element, then visit() with
+    every top level element (node, way, relation, bounds...) once its
+    children are parsed, and finally result().
+    """
+    tags = ('node', 'way')
+
+    def start(self, root):
+        pass
+
+    def visit(self, element):
+        pass
+
+    def result(self):
+        return None
+
+
+###
+# OBJECTIVE: count of empty values, leading or trailing space (auditEmptyValues)
+###
+class EmptyValuesAudit(AuditVisitor):
+    tags = ('node', 'way', 'relation')
+
+    def __init__(self):
+        self.keys = {"empty": 0, "not_empty": 0, "leading_trailing": 0}
+
+    def visit(self, element):
+        for tag in element.iter("tag"):
+            empty_value(tag, self.keys)
+
+    def result(self):
+        return self.keys
+
+
+###
+# OBJECTIVE: house number complements (audit_house_number)
+###
+class HouseNumberAudit(AuditVisitor):
+
+    def __init__(self):
+        self.house_numbers = defaultdict(set)
+
+    def visit(self, element):
+        for tag in element.iter("tag"):
+            if is_house_number(tag):
+                audit_house_number_type(self.house_numbers, tag.attrib['v'])
+
+    def result(self):
+        return self.house_numbers
+
+
+###
+# OBJECTIVE: unexpected street types (auditStreetType)
+###
+class StreetTypeAudit(AuditVisitor):
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+
+    def visit(self, element):
+        for tag in element.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(self.street_types, tag.attrib['v'])
+
+    def result(self):
+        return self.street_types
+
+
+###
+# OBJECTIVE: phone numbers grouped by digit count (audit_phone)
+###
+class PhoneAudit(AuditVisitor):
+
+    def __init__(self):
+        self.phone_len = defaultdict(list)
+
+    def visit(self, element):
+        for tag in element.iter("tag"):
+            if tag.attrib['k'] == 'phone':
+                phone_num = re.sub(r'[\+\(\)\-\s]', '', tag.attrib['v'])
+                self.phone_len[len(phone_num)].append(tag.attrib['v'])
+
+    def result(self):
+        return self.phone_len
+
+
+###
+# OBJECTIVE: count of every element name in the file (count_tags)
+###
+class TagCountAudit(AuditVisitor):
+    tags = None  # every top level element
+
+    def __init__(self):
+        self.tagsList = defaultdict(int)
+
+    def start(self, root):
+        self.tagsList[root.tag] += 1
+
+    def visit(self, element):
+        for elem in element.iter():
+            self.tagsList[elem.tag] += 1
+
+    def result(self):
+        return dict(self.tagsList)
+
+
+###
+# OBJECTIVE: root and first top level elements (parse_firtElements)
+###
+class FirstElementsAudit(AuditVisitor):
+    tags = None  # every top level element
+
+    def __init__(self, count=10):
+        self.count = count
+        self.root = None
+        self.elements = []
+
+    def start(self, root):
+        self.root = (root.tag, dict(root.attrib))
+
+    def visit(self, element):
+        if len(self.elements) <= self.count:
+            self.elements.append((element.tag, dict(element.attrib)))
+
+    def result(self):
+        return {'root': self.root, 'elements': self.elements}
+
+
+# ================================================== #
+#               Bounded Audit Summaries              #
+# ================================================== #
+AUDIT_TOP_N = 10
+AUDIT_MAX_CLASSES = 100
+AUDIT_JSON_PATH = "audit.json"
+# digits counted in a phone number (as in PhoneAudit)
+PHONE_SEPARATORS_RE = re.compile(r'[\+\(\)\-\s]')
+
+###
+# OBJECTIVE: top-k heavy hitters in bounded memory
+###
+class SpaceSaving(object):
+    """Approximate counts of the most frequent items (Space-Saving)
+
+    At most capacity items are tracked. An untracked item replaces the
+    least counted one and inherits its count, recorded as its error, so
+    every item seen more than total/capacity times is in the table and
+    no count is underestimated.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, item, count=1):
+        """Count item; returns the item evicted to make room, if any"""
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+            return None
+        evicted = None
+        floor = 0
+        if len(counts) >= self.capacity:
+            evicted = min(counts, key=counts.get)
+            floor = counts.pop(evicted)
+            del self.errors[evicted]
+        counts[item] = floor + count
+        self.errors[item] = floor
+        return evicted
+
+    def top(self, n=None):
+        """[(item, count), ...] most frequent first"""
+        ranked = sorted(self.counts.iteritems(), key=lambda kv: (-kv[1], kv[0]))
+        return ranked[:n] if n is not None else ranked
+
+
+###
+# OBJECTIVE: count per anomaly class with the top examples of each class
+###
+class AnomalySummary(object):
+    """Bounded summary of the anomalies of one kind of value
+
+    Counts at most max_classes anomaly classes and keeps the top values of
+    each class; memory does not grow with the input.
+    """
+
+    def __init__(self, top=AUDIT_TOP_N, max_classes=AUDIT_MAX_CLASSES):
+        self.top = top
+        self.checked = 0
+        self.anomalies = 0
+        self.classes = SpaceSaving(max_classes)
+        self.examples = {}
+
+    def add(self, value, anomaly_class=None):
+        self.checked += 1
+        if anomaly_class is None:
+            return
+        self.anomalies += 1
+        evicted = self.classes.add(anomaly_class)
+        if evicted is not None:
+            del self.examples[evicted]
+        if anomaly_class not in self.examples:
+            # twice the reported size, so that the top values are stable
+            self.examples[anomaly_class] = SpaceSaving(2 * self.top)
+        self.examples[anomaly_class].add(value)
+
+    def result(self):
+        return {'checked': self.checked,
+                'anomalies': self.anomalies,
+                'classes': [{'class': anomaly_class,
+                             'count': count,
+                             'examples': self.examples[anomaly_class].top(self.top)}
+                            for anomaly_class, count in self.classes.top()]}
+
+
+###
+# OBJECTIVE: street, house number and phone audits in bounded memory
+###
+class AuditSummary(AuditVisitor):
+    """Street type, house number and phone audit with bounded results
+
+    Replaces StreetTypeAudit, HouseNumberAudit and PhoneAudit, which keep
+    every raw value: here each tag is classified once (one dict lookup on
+    its key picks the classifier) and only counts per anomaly class, the
+    top examples of each class and the histogram of the phone lengths
+    are kept. result() is JSON serialisable, see write_json().
+    """
+
+    def __init__(self, top=AUDIT_TOP_N, max_classes=AUDIT_MAX_CLASSES):
+        self.street = AnomalySummary(top, max_classes)
+        self.housenumber = AnomalySummary(top, max_classes)
+        self.phone = AnomalySummary(top, max_classes)
+        self.phone_lengths = defaultdict(int)
+        self.classifiers = {
+            'addr:street': self.classify_street,
+            'addr:housenumber': self.classify_housenumber,
+            'phone': self.classify_phone,
+            'contact:phone': self.classify_phone,
+            'contact:mobile': self.classify_phone,
+        }
+
+    def visit(self, element):
+        classifiers = self.classifiers
+        for tag in element.iter('tag'):
+            classify = classifiers.get(tag.attrib['k'])
+            if classify is not None:
+                classify(tag.attrib['v'])
+
+    def classify_street(self, value):
+        # unexpected first word (street type), as audit_street_type
+        m = STREET_TYPE2_RE.search(value)
+        street_type = m.group() if m else None
+        if street_type is not None and street_type in expected:
+            street_type = None
+        self.street.add(value, street_type)
+
+    def classify_housenumber(self, value):
+        # unexpected complement (B, Ter...), as audit_house_number_type
+        m = housenumber_re.search(value)
+        complement = m.group(3) if m else '<no number>'
+        if complement == '' or complement in expected_housenb:
+            complement = None
+        self.housenumber.add(value, complement)
+
+    def classify_phone(self, value):
+        digits = len(PHONE_SEPARATORS_RE.sub('', value))
+        self.phone_lengths[digits] += 1
+        self.phone.add(value, None if phonenumber_re.match(value)
+                       else '%d digits' % digits)
+
+    def result(self):
+        phone = self.phone.result()
+        phone['lengths'] = dict(self.phone_lengths)
+        return {'street': self.street.result(),
+                'housenumber': self.housenumber.result(),
+                'phone': phone}
+
+    def write_json(self, path=AUDIT_JSON_PATH):
+        with open(path, 'wb') as f:
+            json.dump(self.result(), f, indent=2, sort_keys=True)
+
+###
+# OBJECTIVE: run every audit visitor (and optionally the csv export)
+# in a single iterparse pass over the file
+###
+def audit_map(file_in, visitors, exporter=None):
+    """Run the audit visitors over file_in in one pass and return their results
+
+    When exporter is given (e.g. an open CsvExporter) node, way and
+    relation elements are also written out during the same pass, so that
+    main() parses the osm file only once.
+    """
+    stream = ElementStream(file_in)
+    for visitor in visitors:
+        visitor.start(stream.root)
+
+    for elem in stream:
+        for visitor in visitors:
+            if visitor.tags is None or elem.tag in visitor.tags:
+                visitor.visit(elem)
+        if exporter is not None and elem.tag in EXPORT_TAGS:
+            exporter.write(elem)
+
+    return [visitor.result() for visitor in visitors]
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
 def main():
+    summary = AuditSummary()
+    visitors = [EmptyValuesAudit(), FirstElementsAudit(), TagCountAudit(), summary]
+
+    print "AUDIT AND PROCESSING (single pass)"
+    validator = FastValidator()
+    with SummaryExporter(CsvExporter(validate=validator)) as exporter:
+        keys, first, tags, anomalies = audit_map(OSM_PATH, visitors, exporter)
+    summary.write_json()
+
     print "AUDIT OF EMPTY VALUES/TRAILING AND LEADING SPACE"
-    keys = auditEmptyValues(OSM_PATH)
     pprint.pprint(keys)
  
     print "AUDIT HOUSENUMBERS"
-    housenb_types = audit_house_number(OSM_PATH)
-    pprint.pprint(housenb_types)
+    pprint.pprint(anomalies['housenumber'])
     
     print "LOOK AT FIRST ELEMENTS"
-    parse_firtElements(OSM_PATH)
+    print "root:"
+    print first['root'][0], first['root'][1]
+    for count, (tag, attrib) in enumerate(first['elements']):
+        print count, ":", tag, attrib
     
     print "COUNT TAGS"
-    tags = count_tags(OSM_PATH)
     pprint.pprint(tags)
     
     print "AUDIT STREET TYPES"
-    st_types = auditStreetType(OSM_PATH)
-    pprint.pprint(dict(st_types))
+    pprint.pprint(anomalies['street'])
     
     print "AUDIT PHONE NUMBERS"
-    phone_ln = audit_phone(OSM_PATH)
-    pprint.pprint(dict(phone_ln))
+    pprint.pprint(anomalies['phone'])
+    print "(audit summary written to", AUDIT_JSON_PATH + ")"
+    print "(export statistics written to", SUMMARY_JSON_PATH + ")"
+
+    print "VALIDATION"
+    report = validator.report()
+    print report['checked'], "elements checked,", report['errors'], "errors"
+    pprint.pprint(report['by_field'])
+    pprint.pprint(report['examples'][:10])
 
-    print "PROCESSING"
-    process_map(OSM_PATH, validate=False)
     print "END"
 
 if __name__ == "__main__":